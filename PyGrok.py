@@ -8,22 +8,77 @@ More information: http://esolangs.org/wiki/Grok
 Requires python 3 or higher.
 """
 
+import os
 import sys
 import time
-import random
-from collections import defaultdict
+import operator
+import struct
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, deque
+from functools import partial
 
 # constants
 NCHARS = "0123456789"
-ARITHMETIC = "+-*%" # not division, as it requires special handling
-COMPARISON = { "=": "==", ">": ">" }
+ARITHMETIC = { "+": operator.add, "-": operator.sub, "*": operator.mul, "%": operator.mod } # not division, as it requires special handling
+COMPARISON = { "=": operator.eq, ">": operator.gt }
 DIRECTIONS = { "l": (1,0), "h": (-1,0), "j": (0,1), "k": (0,-1) }
+# the direction each rotation instruction turns the pointer to
+ROTATE_RIGHT = { DIRECTIONS["l"]: DIRECTIONS["j"], DIRECTIONS["j"]: DIRECTIONS["h"],
+                 DIRECTIONS["h"]: DIRECTIONS["k"], DIRECTIONS["k"]: DIRECTIONS["l"] }
+ROTATE_LEFT = { DIRECTIONS["l"]: DIRECTIONS["k"], DIRECTIONS["k"]: DIRECTIONS["h"],
+                DIRECTIONS["h"]: DIRECTIONS["j"], DIRECTIONS["j"]: DIRECTIONS["l"] }
+# statuses returned by Interpreter.run()
+HALTED = "halted"
+BUDGET_EXHAUSTED = "budget exhausted"
+AWAITING_INPUT = "awaiting input"
+VALUE_TOO_LARGE = "value too large"
+# status of a script that stopped with an error, as reported by
+# stream_execute() and execute_batch()
+ERROR = "error"
+# instructions that depend on runtime values, which compiled traces stop at
+TRACE_BARRIERS = "{}q:iI"
+MAX_TRACE_LENGTH = 1024
+# bump whenever the generated code changes, to invalidate cached modules
+COMPILER_VERSION = 1
+COMPILE_CACHE = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "pygrok")
+# snapshots start with this and the version of their format
+SNAPSHOT_MAGIC = b"GRKS"
+SNAPSHOT_VERSION = 1
+# how often --checkpoint saves a snapshot by default
+CHECKPOINT_STEPS = 10000000
+# recordings start with a magic number and a version, and end with an index
+# of their chunks, each of which records up to RECORD_CHUNK_STEPS steps one
+# by one, besides the loops it skips ahead through
+RECORDING_MAGIC = b"GRKR"
+RECORDING_VERSION = 2
+RECORD_CHUNK_STEPS = 4096
+# a chunk starts with a snapshot once the chunks written since the last one
+# take up this many times as much as it did, so that snapshots stay a fixed
+# share of a recording however deep the stack gets
+RECORD_SNAPSHOT_RATIO = 4
+# how far down the stack a recording looks for the value the register was
+# copied from, rather than recording an integer too long for 64 bits
+RECORD_COPY_DEPTH = 8
+# instructions that only pop values, which leave the rest of the stack as it
+# was, so recordings needn't record the new top value
+RECORD_POPS = "xdwzy{}"
+# how often the state is checked for infinite loops, when that is enabled
+LOOP_CHECK_STEPS = 4096
+# the longest loop, in moves, that is looked into for fast-forwarding
+MAX_LOOP_LENGTH = 4096
 
 
 class _Getch:
     """
     Provide cross-platform getch functionality. Shamelessly stolen from
     http://code.activestate.com/recipes/134892/
+    Calling it reads a single character. To read several, use it as a context
+    manager instead, which returns a function reading one character and only
+    switches the terminal mode once:
+        with getch as read_char:
+            ...
     """
     def __init__(self):
         try:
@@ -31,52 +86,141 @@ class _Getch:
         except ImportError:
             self._impl = _GetchUnix()
 
-    def __call__(self): return self._impl()
+    def __call__(self):
+        with self._impl as read_char:
+            return read_char()
+
+    def __enter__(self): return self._impl.__enter__()
+
+    def __exit__(self, *exc_info): return self._impl.__exit__(*exc_info)
 
 
 class _GetchUnix:
     def __init__(self):
         import tty, sys
 
-    def __call__(self):
+    def __enter__(self):
         import sys, tty, termios
-        fd = sys.stdin.fileno()
-        old_settings = termios.tcgetattr(fd)
-        try:
-            tty.setraw(sys.stdin.fileno())
-            ch = sys.stdin.read(1)
-        finally:
-            termios.tcsetattr(fd, termios.TCSADRAIN, old_settings)
-        return ch
+        self._fd = sys.stdin.fileno()
+        self._old_settings = termios.tcgetattr(self._fd)
+        tty.setraw(self._fd)
+        return lambda: sys.stdin.read(1)
+
+    def __exit__(self, *exc_info):
+        import termios
+        termios.tcsetattr(self._fd, termios.TCSADRAIN, self._old_settings)
 
 
 class _GetchWindows:
     def __init__(self):
         import msvcrt
 
-    def __call__(self):
+    def __enter__(self):
         import msvcrt
-        return msvcrt.getch()
+        return msvcrt.getwch
+
+    def __exit__(self, *exc_info):
+        pass
 getch = _Getch()
 
 
+def online_input(input_list):
+    """
+    Return an input function for the online interpreter, which reads the lines
+    of its input box in turn, and "0" once they run out.
+    Arguments:
+        input_list -- the input as a string, one line per ':' instruction, or
+                      as a list of lines
+    """
+    # a deque, so that reading a line costs the same however many are left
+    lines = deque(input_list.split("\n") if isinstance(input_list, str) else input_list)
+
+    def read():
+        return lines.popleft() if lines else "0"
+    return read
+
+
+def console_input():
+    """
+    Return an input function for the console: reading from the user at a
+    terminal, and from the redirected file or pipe otherwise.
+    """
+    if sys.stdin.isatty():
+        return read_string
+    return file_input(sys.stdin)
+
+
+def _lazy_console_input():
+    """
+    Return an input function like console_input()'s, which only looks at
+    stdin once the script first reads from it.
+    """
+    read = None
+
+    def read_line():
+        nonlocal read
+        if read is None:
+            read = console_input()
+        return read()
+    return read_line
+
+
+def file_input(file):
+    """
+    Return an input function which reads the lines of a file one at a time,
+    as they are needed, and "0" for empty lines and once the file runs out.
+    Regular files are memory-mapped rather than read.
+    Arguments:
+        file -- the text file to read from
+    """
+    lines = None
+
+    def read():
+        nonlocal lines
+        if lines is None:
+            lines = _file_lines(file)
+        line = next(lines, None)
+        if not line:
+            return "0"
+        return line.decode(file.encoding or "utf-8", file.errors or "strict")
+    return read
+
+
+def _file_lines(file):
+    """
+    Yield the lines of a file as bytes, without their line endings.
+    """
+    import mmap
+    fd = file.fileno()
+    try:
+        # start wherever the file has been read up to, in case it's shared
+        start = os.lseek(fd, 0, os.SEEK_CUR)
+        data = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        # pipes and empty files can't be mapped
+        for line in file.buffer:
+            yield line[:-1] if line.endswith(b"\n") else line
+        return
+
+    with data:
+        size = len(data)
+        while start < size:
+            end = data.find(b"\n", start)
+            if end < 0:
+                end = size
+            yield data[start:end]
+            start = end + 1
+
+
 def read_string():
-    #Read one character from stdin. Returns 0 when no input is available.
-    if online:
-        # we're online, take input from the input box
-        try:
-            string = inputs.pop(0)
-        except:
-            string = "0"
-        return string
-    elif sys.stdin.isatty():
-        # we're in console, read a character from the user
-        char = " "
-        string = ""
-        sys.stdout.write("> ")
-        sys.stdout.flush()
+    #Read one line from the user at the terminal. Returns "0" for an empty line.
+    string = ""
+    sys.stdout.write("> ")
+    sys.stdout.flush()
+    # stay in raw mode for the whole line, rather than switching for every key
+    with getch as read_char:
         while (True): # while character isn't carriage return or line feed
-            char = getch()
+            char = read_char()
             if ord(char) == 3: # check for ctrl-c (break)
                 sys.stdout.write("^C")
                 sys.stdout.flush()
@@ -90,46 +234,102 @@ def read_string():
             string += str(char)
             sys.stdout.write("\033[2K\r> " + string)
             sys.stdout.flush()
-        sys.stdout.write("\n")
-        if not string:
-            string = "0"
-        return string
-    else:
-        # input is redirected using pipes
-        string = input()
-        # return 0 if there is no more input available
-        return string if string != "" else 0
+    sys.stdout.write("\n")
+    if not string:
+        string = "0"
+    return string
+
+
+# output flushing policies
+FLUSH_UNBUFFERED = "unbuffered" # flush after every instruction, for interactive use
+FLUSH_LINE = "line"             # flush whenever a newline is output
+FLUSH_SIZE = "size"             # flush once enough output has been buffered
+FLUSH_EXIT = "exit"             # only flush when the script stops
+FLUSH_POLICIES = (FLUSH_UNBUFFERED, FLUSH_LINE, FLUSH_SIZE, FLUSH_EXIT)
+# how many steps the online interpreter runs between flushes
+FLUSH_STEPS = 100000
+
+
+class OutputSink:
+    """
+    Collect a script's output locally and pass it on to a writer in chunks,
+    instead of writing every character on its own.
+    """
+    def __init__(self, write, policy=FLUSH_UNBUFFERED, size=65536):
+        """
+        Arguments:
+            write -- a function called with each chunk of output
+            policy -- when buffered output is flushed (see FLUSH_POLICIES)
+            size -- how much output FLUSH_LINE and FLUSH_SIZE will buffer
+                    before flushing regardless
+        """
+        if policy not in FLUSH_POLICIES:
+            raise ValueError("Invalid flush policy", policy)
+        self._write = write
+        self._policy = policy
+        self._size = size
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, string):
+        """
+        Buffer a string, flushing it according to the sink's policy.
+        """
+        self._buffer.append(string)
+        self._buffered += len(string)
+        if (self._policy == FLUSH_UNBUFFERED
+                or (self._policy == FLUSH_LINE and "\n" in string)
+                or (self._policy != FLUSH_EXIT and self._buffered >= self._size)):
+            self.flush()
+
+    def flush(self):
+        """
+        Pass everything buffered so far on to the writer.
+        """
+        if self._buffer:
+            chunk = "".join(self._buffer)
+            self._buffer = []
+            self._buffered = 0
+            self._write(chunk)
+
+
+def write_stdout(string):
+    # write a chunk of output to the console right away
+    sys.stdout.write(string)
+    sys.stdout.flush()
 
 
 class Interpreter:
     """
     Grok interpreter.
     """
-    def __init__(self, code):
+    def __init__(self, code, output=None, input=None, int64=False):
         """
         Initialize a new interpreter.
         Arguments:
             code -- the code to execute as a string
+            output -- the OutputSink to write output to (default: unbuffered
+                      console output)
+            input -- a function returning the next line of input, or None if
+                     none is available yet (default: console_input())
+            int64 -- keep the stack in a typed array of 64-bit integers, which
+                     wrap around on overflow, and always divide integers
         """
         # check for hashbang in first line
         lines = code.split("\n")
         if lines[0][:2] == "#!":
             code = "\n".join(lines[1:])
 
-        # construct a 2D defaultdict to contain the code
-        self._wordbox = defaultdict(lambda: defaultdict(int))
-        line_n = char_n = 0
-        for char in code:
-            if char != "\n":
-                self._wordbox[line_n][char_n] = 0 if char == " " else ord(char)
-                char_n += 1
-            else:
-                char_n = 0
-                line_n += 1
-
-
-        self._position = [-1,0]
-        self._direction = DIRECTIONS["l"]
+        # construct an immutable grid of rows to contain the code. grok can't
+        # modify its own source, so the row widths and count never change.
+        # NUL characters are treated like spaces, as they are NOPs either way
+        rows = code.replace("\0", " ").split("\n")
+        # trailing empty lines aren't part of the wordbox
+        while len(rows) > 1 and not rows[-1]:
+            rows.pop()
+        self._wordbox = tuple(rows)
+        self._widths = tuple(len(row) for row in rows)
+        self._height = len(rows)
 
         # are we in debug mode? (real error messages displayed)
         self._debug = False
@@ -137,6 +337,47 @@ class Interpreter:
         # are we using integer division?
         self._int_div = False
 
+        # are we using 64-bit integers?
+        self._int64 = int64
+
+        # do we stop scripts that are stuck in an infinite loop?
+        self._detect_loops = False
+
+        # do we skip ahead through loops that just count (see
+        # _summarise_loop())? only done within _execute()
+        self._summarise_loops = True
+        self._fast_forward = False
+
+        # how many bits an integer may grow to before run() stops, as every
+        # step on it gets slower (default: unlimited)
+        self._max_bits = None
+
+        self._sink = output if output is not None else OutputSink(write_stdout)
+        self._read = input if input is not None else _lazy_console_input()
+
+        self._instructions = self._build_instructions()
+
+        # where each run of spaces leads, by its first cell and direction.
+        # see _nop_run()
+        self._nop_runs = {}
+        # the loop closed by each { and }, by its cell and the direction it
+        # is left in, as a LoopSummary or None. see _summarise_loop()
+        self._loops = {}
+
+        # hash of the wordbox, which snapshots refer to the script by
+        self._hash = None
+
+        self.reset()
+
+
+    def reset(self):
+        """
+        Put the script back at its start, with an empty stack and register,
+        so that it can be run again without parsing it again.
+        """
+        self._position = [-1,0]
+        self._direction = DIRECTIONS["l"]
+
         # the register is initially empty
         self._register = 0
         # string mode is initially disabled
@@ -147,83 +388,548 @@ class Interpreter:
 
         self._insert_string = ""
 
-        self._stack = []
+        self._stack = array("q") if self._int64 else []
+        # can the stack hold floats? it only holds ints until an operation
+        # produces a float, and until then values needn't be converted
+        self._floats = False
 
         # is the last outputted character a newline?
         self._newline = None
 
+        # the number of steps executed so far
+        self._steps = 0
+        # has the script stopped? if so, why
+        self._halted = False
+        self._message = None
+        # is an input instruction waiting for input to become available?
+        self._awaiting_input = False
+
+        # the number of input and output instructions executed so far, as
+        # states with I/O in between never count as a loop
+        self._io = 0
+        # loop detection: a saved state and its stack, the number of checks
+        # since it was saved, and the number of checks before the next save
+        self._loop_state = None
+        self._loop_checks = 0
+        self._loop_power = 1
+
+
+    def snapshot(self):
+        """
+        Return the execution state as a compact binary blob, which restore()
+        can continue from. The script itself isn't included, only its hash.
+        """
+        direction = tuple(DIRECTIONS.values()).index(self._direction)
+        mode = (None, "insert", "regin").index(self._string_mode)
+        flags = (self._skip | self._num_entered << 1 | self._halted << 2 | self._awaiting_input << 3 |
+                 self._floats << 4)
+        newline = (None, False, True).index(self._newline)
+        parts = [struct.pack("<qqBBBBQ", self._position[0], self._position[1], direction, mode, flags,
+                             newline, self._steps),
+                 _pack_value(self._register),
+                 _pack_string(self._insert_string),
+                 _pack_string(self._message or "")]
+
+        # most stacks are all small integers or all floats, which can be
+        # copied in one go instead of value by value
+        stack = self._stack
+        for kind, typecode in enumerate("qd"):
+            # integers are only stored as floats if that doesn't lose anything
+            if typecode == "d" and not all(isinstance(value, float) for value in stack):
+                continue
+            try:
+                values = array(typecode, stack)
+            except (TypeError, OverflowError):
+                continue
+            if sys.byteorder == "big":
+                values.byteswap()
+            parts.append(struct.pack("<BQ", kind, len(stack)))
+            parts.append(values.tobytes())
+            break
+        else:
+            parts.append(struct.pack("<BQ", 2, len(stack)))
+            parts.extend(_pack_value(value) for value in stack)
+
+        return SNAPSHOT_MAGIC + bytes([SNAPSHOT_VERSION]) + self._program_hash() + zlib.compress(b"".join(parts), 1)
+
+    def restore(self, snapshot):
+        """
+        Continue from the execution state in a blob returned by snapshot().
+        Raises ValueError if the snapshot is invalid or of another script.
+        """
+        header = len(SNAPSHOT_MAGIC) + 1
+        if snapshot[:header] != SNAPSHOT_MAGIC + bytes([SNAPSHOT_VERSION]):
+            raise ValueError("Not a snapshot of this version")
+        if snapshot[header:header + 32] != self._program_hash():
+            raise ValueError("Snapshot of a different script")
+        try:
+            data = zlib.decompress(snapshot[header + 32:])
+            x, y, direction, mode, flags, newline, steps = struct.unpack_from("<qqBBBBQ", data)
+            offset = struct.calcsize("<qqBBBBQ")
+            register, offset = _unpack_value(data, offset)
+            insert_string, offset = _unpack_string(data, offset)
+            message, offset = _unpack_string(data, offset)
+
+            kind, count = struct.unpack_from("<BQ", data, offset)
+            offset += struct.calcsize("<BQ")
+            if kind == 2:
+                stack = []
+                for _ in range(count):
+                    value, offset = _unpack_value(data, offset)
+                    stack.append(value)
+            else:
+                values = array("qd"[kind])
+                values.frombytes(data[offset:offset + count * values.itemsize])
+                if sys.byteorder == "big":
+                    values.byteswap()
+                stack = values.tolist()
+            if len(stack) != count:
+                raise ValueError("Truncated snapshot")
+
+            state = (tuple(DIRECTIONS.values())[direction], (None, "insert", "regin")[mode],
+                     (None, False, True)[newline])
+        except (zlib.error, struct.error, IndexError) as e:
+            raise ValueError("Invalid snapshot") from e
+
+        self._position = [x, y]
+        self._direction, self._string_mode, self._newline = state
+        self._skip = bool(flags & 1)
+        self._num_entered = bool(flags & 2)
+        self._halted = bool(flags & 4)
+        self._awaiting_input = bool(flags & 8)
+        self._steps = steps
+        self._register = register
+        self._insert_string = insert_string
+        self._message = message or None
+        if self._int64:
+            try:
+                stack = array("q", stack)
+            except (TypeError, OverflowError) as e:
+                raise ValueError("Snapshot of a stack that doesn't fit in 64 bits") from e
+        self._stack = stack
+        # a float may only be in the register, so float mode is saved along
+        # with the state. snapshots from before that was saved only have the
+        # stack to go by
+        self._floats = bool(flags & 16) or any(isinstance(value, float) for value in stack)
+        # states saved before don't lead here
+        self._loop_state = None
+        self._loop_checks = 0
+        self._loop_power = 1
+
+    def _program_hash(self):
+        """
+        Return the sha256 digest of the wordbox.
+        """
+        if self._hash is None:
+            import hashlib
+            self._hash = hashlib.sha256("\n".join(self._wordbox).encode("utf-8", "surrogatepass")).digest()
+        return self._hash
+
 
     def move(self):
         """
         Move one step in the execution process, and handle the instruction (if
         any) at the new position.
         """
+        self._steps += 1
         # move one step in the current direction
         self._position[0] += self._direction[0]
         self._position[1] += self._direction[1]
 
         # wrap around if we reach the borders of the wordbox
-        if self._position[1] > max(self._wordbox.keys()):
+        if self._position[1] >= self._height:
             # if the current position is beyond the number of lines, wrap to the top
             self._position[1] = 0
         elif self._position[1] < 0:
             # if we're above the top, move to the bottom
-            self._position[1] = max(self._wordbox.keys())
+            self._position[1] = self._height - 1
 
-        if self._direction[0] == 1 and self._position[0] > max(self._wordbox[self._position[1]].keys()):
+        width = self._widths[self._position[1]]
+        if self._direction[0] == 1 and self._position[0] >= width:
             # wrap to the beginning if we are beyond the last character on a line and moving rightwards
-            self._position[0] = 0;
+            self._position[0] = 0
         elif self._position[0] < 0:
             # also wrap if we reach the left hand side
-            self._position[0] = max(self._wordbox[self._position[1]].keys())
+            self._position[0] = width - 1
 
         # execute the instruction found
         if not self._skip:
-            instruction = int(self._wordbox[self._position[1]][self._position[0]])
-            # the current position might not be a valid character
+            # cells outside of the current row's width are empty
+            x = self._position[0]
+            instruction = self._wordbox[self._position[1]][x] if 0 <= x < width else " "
             try:
-                # use space if current cell is 0
-                instruction = chr(instruction) if instruction > 0 else " "
-            except:
-                instruction = None
-            if self._debug:
-                try:
-                    self._handle_instruction(instruction)
-                except StopExecution:
-                    raise
-                except KeyboardInterrupt:
-                    # avoid catching as error
-                    raise KeyboardInterrupt
-            else:
-                try:
-                    self._handle_instruction(instruction)
-                except StopExecution:
+                self._handle_instruction(instruction)
+            except (StopExecution, AwaitingInput, ValueTooLarge):
+                raise
+            except KeyboardInterrupt:
+                # avoid catching as error
+                raise KeyboardInterrupt
+            except Exception as e:
+                if self._debug:
                     raise
-                except KeyboardInterrupt:
-                    # avoid catching as error
-                    raise KeyboardInterrupt
-                except Exception as e:
-                    raise StopExecution("You don't grok Grok.")
+                raise StopExecution("You don't grok Grok.")
             return instruction
 
         self._skip = False
 
-    def _handle_instruction(self, instruction):
+    def run(self, max_steps=None):
         """
-        Execute an instruction.
+        Execute up to max_steps steps (or until the script stops, if None) in
+        a tight loop. Can be called again to carry on where it left off.
+        Returns one of:
+            HALTED -- the script stopped; its error message, if any, is in
+                      self._message
+            BUDGET_EXHAUSTED -- max_steps steps were executed
+            AWAITING_INPUT -- the script needs input that isn't available
+                              yet; the input instruction is retried next run
+            VALUE_TOO_LARGE -- an arithmetic instruction made an integer
+                               longer than self._max_bits bits. It was
+                               executed, so the script can carry on from here
         """
-        if instruction == None:
-            # error on invalid characters
-            raise Exception
+        if self._halted:
+            return HALTED
+        try:
+            if self._awaiting_input:
+                self._awaiting_input = False
+                self._read_input()
+            max_steps = float("inf") if max_steps is None else max_steps
+            if self._detect_loops:
+                self._execute_checked(max_steps)
+            else:
+                self._execute(max_steps)
+        except StopExecution as stop:
+            self._halted = True
+            self._message = stop.message
+            return HALTED
+        except AwaitingInput:
+            self._awaiting_input = True
+            return AWAITING_INPUT
+        except ValueTooLarge:
+            return VALUE_TOO_LARGE
+        except KeyboardInterrupt:
+            # avoid catching as error
+            raise KeyboardInterrupt
+        except Exception as e:
+            if self._debug:
+                raise
+            self._halted = True
+            self._message = "You don't grok Grok."
+            return HALTED
+        return BUDGET_EXHAUSTED
 
+    def _execute(self, max_steps):
+        """
+        Execute up to max_steps steps. This does the same as calling move()
+        repeatedly, without the overhead of a call and try block per step.
+        """
+        wordbox = self._wordbox
+        widths = self._widths
+        height = self._height
+        position = self._position
+        handle_instruction = self._handle_instruction
+        nop_runs = self._nop_runs
+        steps = 0
+        self._fast_forward = self._summarise_loops
+        try:
+            while steps < max_steps:
+                steps += 1
+                direction = self._direction
+                x = position[0] + direction[0]
+                y = position[1] + direction[1]
+                if y >= height:
+                    y = 0
+                elif y < 0:
+                    y = height - 1
+                width = widths[y]
+                if direction[0] == 1 and x >= width:
+                    x = 0
+                elif x < 0:
+                    x = width - 1
+                position[0] = x
+                position[1] = y
+
+                if self._skip:
+                    self._skip = False
+                    continue
+                instruction = wordbox[y][x] if 0 <= x < width else " "
+                # spaces are NOPs unless they are part of a string
+                if instruction != " " or self._string_mode is not None:
+                    try:
+                        handle_instruction(instruction)
+                    except FastForward as loop:
+                        # skip the iterations that fit in the remaining steps
+                        count = loop.count
+                        if max_steps != float("inf"):
+                            fit = int(max_steps - steps) // loop.summary.length
+                            count = fit if count is None else min(count, fit)
+                        if count:
+                            loop.summary.apply(self, count)
+                            steps += count * loop.summary.length
+                else:
+                    # jump over the rest of the spaces, counting a step for
+                    # each of them, if they fit in the remaining steps
+                    key = (x, y, direction)
+                    try:
+                        run = nop_runs[key]
+                    except KeyError:
+                        run = nop_runs[key] = self._nop_run(x, y, direction)
+                    if run is not None and steps + run[2] <= max_steps:
+                        position[0], position[1], moves = run
+                        steps += moves
+        finally:
+            self._steps += steps
+            self._fast_forward = False
+
+    def _nop_run(self, x, y, direction):
+        """
+        Follow the spaces from (x, y) in a direction, and return the last one
+        before the next instruction along with the number of moves it takes
+        to get there, as (x, y, moves). Returns None if there are only spaces
+        ahead.
+        """
+        seen = {(x, y)}
+        moves = 0
+        while True:
+            next_x, next_y = self._advance(x, y, direction)
+            if self._cell(next_x, next_y) != " ":
+                return x, y, moves
+            if (next_x, next_y) in seen:
+                return None
+            seen.add((next_x, next_y))
+            x, y = next_x, next_y
+            moves += 1
+
+    def _execute_checked(self, max_steps):
+        """
+        Execute up to max_steps steps like _execute(), checking for infinite
+        loops every LOOP_CHECK_STEPS steps.
+        """
+        end = self._steps + max_steps
+        while self._steps < end:
+            # check at fixed step counts, however the steps are split up into
+            # runs, so that the checks line up with any loop
+            self._execute(min(LOOP_CHECK_STEPS - self._steps % LOOP_CHECK_STEPS, end - self._steps))
+            if self._steps % LOOP_CHECK_STEPS == 0:
+                self._check_loop()
+
+    def _check_loop(self):
+        """
+        Stop the script if it is back in a state it has been in before, with no
+        input or output in between. Scripts are deterministic, so it would
+        repeat the same steps forever.
+        Uses Brent's algorithm: the state is compared with one saved earlier,
+        which is moved up to the current state after 1, 2, 4, 8... checks, so
+        that any loop is found within a few times its length of it starting.
+        """
+        position = self._position
+        register = self._register
+        state = (self._io, position[0], position[1], self._direction, self._string_mode, self._skip,
+                 self._num_entered, type(register), register, self._insert_string, self._floats)
+        stack = self._stack
+        saved = self._loop_state
+        # the stack is only compared when everything else is the same, and
+        # its length before its values
+        if saved is not None and state == saved[0] and stack == saved[1]:
+            # 1 == 1.0, but they don't behave the same
+            if not self._floats or all(type(a) is type(b) for a, b in zip(stack, saved[1])):
+                raise StopExecution("infinite loop detected at ({}, {})".format(position[0], position[1]))
+        self._loop_checks += 1
+        if self._loop_checks == self._loop_power:
+            self._loop_state = (state, stack[:])
+            self._loop_checks = 0
+            self._loop_power *= 2
+
+    def _summarise_loop(self, x, y, direction):
+        """
+        Follow the path leaving the { or } at (x, y) in a direction, and
+        return a LoopSummary of what one trip around it does if it comes back
+        to (x, y) in the same direction and just counts. Returns None if the
+        path goes anywhere else, or does anything else on the way.
+        Counting means no I/O, the stack staying the same height, and every
+        value it touches (and the register) either changing by a constant,
+        being set to a constant, or being set to a counter plus a constant,
+        where the value tested by the { or } is a counter. Values are tracked
+        as (variable, constant) pairs, where the variable is None for a
+        constant, 0 for the register and n for the nth value from the top of
+        the stack as the trip starts.
+        """
+        if self._int64:
+            # wrapping around isn't affine
+            return None
+        start = (x, y, direction)
+        pushed = []
+        # stack values popped from below the pushed ones, and the deepest
+        # value read
+        popped = [0]
+        deepest = [0]
+
+        def pop():
+            if pushed:
+                return pushed.pop()
+            popped[0] += 1
+            deepest[0] = max(deepest[0], popped[0])
+            return popped[0], 0
+
+        def copy(index):
+            # the value index places below the top
+            if index < len(pushed):
+                return pushed[-1 - index]
+            variable = popped[0] + 1 + index - len(pushed)
+            deepest[0] = max(deepest[0], variable)
+            return variable, 0
+
+        def constant():
+            variable, value = pop()
+            if variable is not None:
+                raise ValueError
+            return value
+
+        register = (0, 0)
+        skip = False
+        string = None
+        try:
+            for moves in range(1, MAX_LOOP_LENGTH + 1):
+                x, y = self._advance(x, y, direction)
+                if skip:
+                    skip = False
+                    continue
+                instruction = self._cell(x, y)
+                if string is not None:
+                    # insert mode, handled like _handle_instruction() does
+                    if instruction != "`":
+                        string += instruction
+                    elif all(char in NCHARS for char in string):
+                        if string:
+                            pushed.append((None, int(string)))
+                        string = None
+                    else:
+                        pushed.extend((None, ord(char)) for char in reversed(string))
+                        string = None
+                    continue
+                if (x, y, direction) == start:
+                    # back where the trip started, which pops the value tested
+                    test = pop()
+                    break
+
+                if instruction in DIRECTIONS:
+                    direction = DIRECTIONS[instruction]
+                elif instruction in NCHARS:
+                    pushed.append((None, int(instruction)))
+                elif instruction == " ":
+                    pass
+                elif instruction == "`":
+                    skip = True
+                elif instruction in "+-":
+                    a, b = pop(), pop()
+                    if a[0] is None:
+                        pushed.append((b[0], ARITHMETIC[instruction](b[1], a[1])))
+                    elif instruction == "+" and b[0] is None:
+                        pushed.append((a[0], a[1] + b[1]))
+                    else:
+                        return None
+                elif instruction in "*%":
+                    a = constant()
+                    pushed.append((None, ARITHMETIC[instruction](constant(), a)))
+                elif instruction in COMPARISON:
+                    a = constant()
+                    pushed.append((None, 1 if COMPARISON[instruction](constant(), a) else 0))
+                elif instruction == "!":
+                    pushed.append((None, 0 if constant() else 1))
+                elif instruction in "{}":
+                    if not constant():
+                        direction = (ROTATE_RIGHT if instruction == "}" else ROTATE_LEFT)[direction]
+                elif instruction == "i":
+                    string = ""
+                elif instruction == "y":
+                    a = constant()
+                    if a < 0:
+                        # counts from the bottom of the stack
+                        return None
+                    register = copy(a)
+                elif instruction == "Y":
+                    register = copy(0)
+                elif instruction in "pP":
+                    pushed.append(register)
+                    if instruction == "p":
+                        register = (None, 0)
+                elif instruction == "x":
+                    pop()
+                elif instruction == "X":
+                    register = (None, 0)
+                elif instruction == "d":
+                    a = constant()
+                    if a == 0:
+                        register = pop()
+                    elif a > MAX_LOOP_LENGTH:
+                        return None
+                    for _ in range(a):
+                        pop()
+                else:
+                    # I/O, quitting, regin mode, division, invalid instructions
+                    return None
+            else:
+                return None
+        except (ValueError, ZeroDivisionError):
+            # a value only known at runtime decides what happens
+            return None
+
+        # the trip has to leave the stack as high as it was, with the
+        # values it pushed taking the place of the ones it popped
+        if len(pushed) != popped[0]:
+            return None
+        updates = {0: register}
+        for variable in range(1, popped[0] + 1):
+            updates[variable] = pushed[-variable]
+        # values below the ones popped stay the same
+        steps = {variable: 0 for variable in range(popped[0] + 1, deepest[0] + 1)}
+        steps.update((variable, value) for variable, (source, value) in updates.items() if source == variable)
+        for variable, (source, value) in updates.items():
+            if source is not None and source not in steps:
+                # copied from something other than a counter
+                return None
+        if not any(steps.values()) or (test[0] is not None and test[0] not in steps):
+            # loops that don't count are left to _check_loop()
+            return None
+        if test == (None, 0):
+            return None
+        return LoopSummary(moves, deepest[0], updates, steps, test)
+
+    def _advance(self, x, y, direction):
+        """
+        Return the position one step from (x, y), wrapping around the same way
+        move() does. Used to follow paths through the wordbox without running
+        them.
+        """
+        x += direction[0]
+        y += direction[1]
+        if y >= self._height:
+            y = 0
+        elif y < 0:
+            y = self._height - 1
+        width = self._widths[y]
+        if direction[0] == 1 and x >= width:
+            x = 0
+        elif x < 0:
+            x = width - 1
+        return x, y
+
+    def _cell(self, x, y):
+        """
+        Return the instruction at (x, y).
+        """
+        return self._wordbox[y][x] if 0 <= x < self._widths[y] else " "
 
+    def _handle_instruction(self, instruction):
+        """
+        Execute an instruction.
+        """
         # handle insert mode
-        if self._string_mode == "insert" and instruction != "`":
-            self._insert_string += str(instruction)
-            return
+        if self._string_mode == "insert":
+            if instruction != "`":
+                self._insert_string += str(instruction)
+                return
 
-        # handle insert escape
-        elif self._string_mode == "insert" and instruction == "`":
+            # handle insert escape
             is_num = True
             string = self._insert_string
             for char in string:
@@ -242,14 +948,19 @@ class Interpreter:
             self._insert_string = ""
             self._string_mode = None
 
-
         # handle regin mode
-        elif self._string_mode == "regin" and instruction != "`":
-            if instruction in NCHARS:        # if the instruction is a number, push it and continue in regin
+        elif self._string_mode == "regin":
+            if instruction == "`":
+                # handle regin escape
+                if self._num_entered:
+                    self._register = int(self._register)
+                    self._num_entered = False
+                self._skip = True
+                self._string_mode = None
+            elif instruction in NCHARS:        # if the instruction is a number, push it and continue in regin
                 self._register = ( str(instruction) if not self._num_entered else self._register + str(instruction) )
                 self._num_entered = True
-                return
-            elif instruction not in NCHARS:
+            else:
                 self._string_mode = None        # if the instruction is not a number, end regin mode and execute it
                 if self._num_entered:
                     self._register = int(self._register)
@@ -257,174 +968,202 @@ class Interpreter:
                     self._handle_instruction(instruction)
                 else:
                     self._register = ord(instruction)  # if not a number and is first instruction in regin,
-                    return                             # push it and end regin mode
-
-        # handle regin escape
-        elif self._string_mode == "regin" and instruction == "`":
-            if self._num_entered:
-                self._register = int(self._register)
-                self._num_entered = False
-            self._skip = True
-            self._string_mode = None
-
-
-        # handle escape
-        elif self._string_mode == None and instruction == "`":
-            self._skip = True
+                                                       # push it and end regin mode
 
+        else:
+            handler = self._instructions.get(instruction)
+            if handler is None:
+                # invalid instruction
+                raise Exception("Invalid instruction", instruction)
+            handler()
 
+    def _build_instructions(self):
+        """
+        Return a table mapping every instruction to a prebound handler, so
+        executing an instruction costs a single dictionary lookup.
+        """
+        instructions = {
+            # space is NOP
+            " ": self._nop,
+            "`": self._escape,
+            "!": self._not,
+            "/": self._divide,
+            "i": self._insert_mode,
+            "I": self._regin_mode,
+            "y": self._copy_to_register,
+            "Y": self._top_to_register,
+            "p": self._pop_register,
+            "P": self._copy_register,
+            "x": self._discard,
+            "X": self._clear_register,
+            "d": self._drop,
+            "}": partial(self._rotate, ROTATE_RIGHT),
+            "{": partial(self._rotate, ROTATE_LEFT),
+            "w": self._output_char,
+            "W": self._output_register_char,
+            "z": self._output_number,
+            "Z": self._output_register_number,
+            ":": self._read_input,
+            "q": self._quit,
+        }
         # instruction is one of kjlh, change direction
-        elif instruction in DIRECTIONS:
-            self._direction = DIRECTIONS[instruction]
-
+        for char, direction in DIRECTIONS.items():
+            instructions[char] = partial(setattr, self, "_direction", direction)
         # instruction is 0-9, push corresponding int value
-        elif instruction in NCHARS:
-            self._push(int(instruction))
-
-        # instruction is an arithmetic operator
-        elif instruction in ARITHMETIC:
-            a, b = self._pop(), self._pop()
-            exec("self._push(b{}a)".format(instruction))
-
-        # division
-        elif instruction == "/":
-            a, b = self._pop(), self._pop()
-            if self._int_div:
-                a, b = int(a), int(b)
-                self._push(b//a)
-            else:
-                # try converting them to floats for python 2 compability
-                try:
-                    a, b = float(a), float(b)
-                except OverflowError:
-                    pass
-                self._push(b/a)
-
-        # comparison operators
-        elif instruction in COMPARISON:
-            a, b = self._pop(), self._pop()
-            exec("self._push(1 if b{}a else 0)".format(COMPARISON[instruction]))
-
-        # logical NOT
-        elif instruction == "!":
-            a = self._pop()
-            self._push(0) if a else self._push(1)
-
-        # turn on string mode
-        elif instruction == "i": # turn on string parsing
-            self._string_mode = "insert"
-
-        elif instruction == "I": # turn on "regin" string parsing
-            self._string_mode = "regin"
-
-        # duplicate ath value on stack to the register
-        elif instruction == "y":
-            a = self._pop()
-            self._register = self._copy(-(1+a))
-
-        # duplicate top of stack to the register
-        elif instruction == "Y":
-            self._register = self._copy(-1)
-
-        # pop register value and push it to the stack
-        elif instruction == "p":
-            self._push(self._register)
-            self._register = 0
-
-        # duplicate register value to the stack
-        elif instruction == "P":
-            self._push(self._register)
-
-        # remove top of stack
-        elif instruction == "x":
-            self._pop()
-
-        # remove register value
-        elif instruction == "X":
-            self._register = 0
-
-        # remove a values from stack, or push to register if a == 0
-        elif instruction == "d":
-            a = self._pop()
-            if a:
-                for x in range(a): self._pop()
-            else: self._register = self._pop()
-
-        # rotate pointer right
-        elif instruction == "}":
-            d = self._direction
-            a = self._pop()
-            if not a:
-                if d == DIRECTIONS["l"]:
-                    self._direction = DIRECTIONS["j"]
-                elif d == DIRECTIONS["j"]:
-                    self._direction = DIRECTIONS["h"]
-                elif d == DIRECTIONS["h"]:
-                    self._direction = DIRECTIONS["k"]
-                elif d == DIRECTIONS["k"]:
-                    self._direction = DIRECTIONS["l"]
-
-        # rotate pointer left
-        elif instruction == "{":
-            d = self._direction
-            a = self._pop()
-            if not a:
-                if d == DIRECTIONS["l"]:
-                    self._direction = DIRECTIONS["k"]
-                elif d == DIRECTIONS["k"]:
-                    self._direction = DIRECTIONS["h"]
-                elif d == DIRECTIONS["h"]:
-                    self._direction = DIRECTIONS["j"]
-                elif d == DIRECTIONS["j"]:
-                    self._direction = DIRECTIONS["l"]
-
-        # pop and output as character
-        elif instruction == "w":
-            self._output(chr(int(self._pop())))
-
-        # pop from register and output as character
-        elif instruction == "W":
-            self._output(chr(int(self._register)))
-            self._register = 0
-
-        # pop and output as number
-        elif instruction == "z":
-            n = self._pop()
-            # try outputting without the decimal point if possible
-            self._output(int(n) if int(n) == n else n)
-
-        # pop from register and output as number
-        elif instruction == "Z":
-            n = self._register
-            self._output(int(n) if int(n) == n else n)
-            self._register = 0
-
-        # handle input
-        elif instruction == ":":
-            i = self._input()
-            is_num = True
-            for char in i:
-                if char not in NCHARS:
-                    is_num = False
-                    break
-            if is_num:
-                self._push(int(i))
+        for char in NCHARS:
+            instructions[char] = partial(self._push, int(char))
+        for char, operation in ARITHMETIC.items():
+            instructions[char] = partial(self._arithmetic, operation)
+        for char, operation in COMPARISON.items():
+            instructions[char] = partial(self._compare, operation)
+        return instructions
+
+    def _nop(self):
+        pass
+
+    # handle escape
+    def _escape(self):
+        self._skip = True
+
+    # instruction is an arithmetic operator
+    def _arithmetic(self, operation):
+        a, b = self._pop(), self._pop()
+        value = operation(b, a)
+        self._push(value)
+        if self._max_bits is not None and type(value) is int and value.bit_length() > self._max_bits:
+            raise ValueTooLarge()
+
+    # division
+    def _divide(self):
+        a, b = self._pop(), self._pop()
+        if self._int_div or self._int64:
+            a, b = int(a), int(b)
+            self._push(b//a)
+        else:
+            # try converting them to floats for python 2 compability
+            try:
+                a, b = float(a), float(b)
+            except OverflowError:
+                pass
+            quotient = b/a
+            # whole quotients stay ints, anything else puts the stack in
+            # float mode
+            if quotient.is_integer():
+                quotient = int(quotient)
             else:
-                i = i[::-1]
-                for char in i:
-                    self._push(ord(char))
+                self._floats = True
+            self._push(quotient)
+
+    # comparison operators
+    def _compare(self, operation):
+        a, b = self._pop(), self._pop()
+        self._push(1 if operation(b, a) else 0)
+
+    # logical NOT
+    def _not(self):
+        a = self._pop()
+        self._push(0) if a else self._push(1)
+
+    # turn on string mode
+    def _insert_mode(self): # turn on string parsing
+        self._string_mode = "insert"
+
+    def _regin_mode(self): # turn on "regin" string parsing
+        self._string_mode = "regin"
+
+    # duplicate ath value on stack to the register
+    def _copy_to_register(self):
+        a = self._pop()
+        self._register = self._copy(-(1+a))
+
+    # duplicate top of stack to the register
+    def _top_to_register(self):
+        self._register = self._copy(-1)
+
+    # pop register value and push it to the stack
+    def _pop_register(self):
+        self._push(self._register)
+        self._register = 0
 
-        # the end
-        elif instruction == "q":
-            raise StopExecution()
+    # duplicate register value to the stack
+    def _copy_register(self):
+        self._push(self._register)
 
-        # space is NOP
-        elif instruction == " ":
-            pass
+    # remove top of stack
+    def _discard(self):
+        self._pop()
+
+    # remove register value
+    def _clear_register(self):
+        self._register = 0
+
+    # remove a values from stack, or push to register if a == 0
+    def _drop(self):
+        a = self._pop()
+        if a:
+            # popping past the bottom of the stack does nothing, so stop there
+            for x in range(a)[:len(self._stack)]: self._pop()
+        else: self._register = self._pop()
+
+    # rotate pointer right or left
+    def _rotate(self, rotation):
+        a = self._pop()
+        if not a:
+            self._direction = rotation[self._direction]
+        elif self._fast_forward and not self._floats:
+            # staying on course repeats the loop this closes, if any
+            key = (self._position[0], self._position[1], self._direction)
+            try:
+                summary = self._loops[key]
+            except KeyError:
+                summary = self._loops[key] = self._summarise_loop(*key)
+            if summary is not None:
+                count = summary.iterations(self)
+                if count is None or count > 1:
+                    raise FastForward(summary, count)
+
+    # pop and output as character
+    def _output_char(self):
+        self._output(chr(int(self._pop())))
+
+    # pop from register and output as character
+    def _output_register_char(self):
+        self._output(chr(int(self._register)))
+        self._register = 0
 
-        # invalid instruction
+    # pop and output as number
+    def _output_number(self):
+        n = self._pop()
+        # try outputting without the decimal point if possible
+        self._output(int(n) if int(n) == n else n)
+
+    # pop from register and output as number
+    def _output_register_number(self):
+        n = self._register
+        self._output(int(n) if int(n) == n else n)
+        self._register = 0
+
+    # handle input
+    def _read_input(self):
+        i = self._input()
+        if i is None:
+            # no input available yet, run() retries this instruction later
+            raise AwaitingInput()
+        is_num = True
+        for char in i:
+            if char not in NCHARS:
+                is_num = False
+                break
+        if is_num:
+            self._push(int(i))
         else:
-            raise Exception("Invalid instruction", instruction)
+            i = i[::-1]
+            for char in i:
+                self._push(ord(char))
+
+    # the end
+    def _quit(self):
+        raise StopExecution()
 
     def _push(self, value, index=None):
         """
@@ -432,7 +1171,14 @@ class Interpreter:
         Keyword arguments:
             index -- the index to push/insert to. (default: end of stack)
         """
-        self._stack.insert(len(self._stack) if index == None else index, value)
+        try:
+            if index is None:
+                self._stack.append(value)
+            else:
+                self._stack.insert(index, value)
+        except (OverflowError, TypeError):
+            # only the int64 stack rejects values, so wrap them to fit
+            self._push(_wrap64(int(value)), index)
 
     def _pop(self, index=None):
         """
@@ -442,11 +1188,11 @@ class Interpreter:
         """
         # if there are no values to pop, return 0
         try:
-            value = self._stack.pop(len(self._stack)-1 if index == None else index)
+            value = self._stack.pop() if index is None else self._stack.pop(index)
         except IndexError:
-            value = 0
+            return 0
         # convert to int where possible to avoid float overflow
-        if value == int(value):
+        if self._floats and value == int(value):
             value = int(value)
         return value
 
@@ -460,32 +1206,73 @@ class Interpreter:
         try:
             value = self._stack[index]
         except IndexError:
-            value = 0
+            return 0
         # convert to int where possible to avoid float overflow
-        if value == int(value):
+        if self._floats and value == int(value):
             value = int(value)
         return value
 
     def _input(self):
         """
-        Return an inputted character.
+        Return an inputted character, or None if no input is available yet.
         """
-        return read_string()
+        # make sure any prompt has been shown before waiting for input
+        self._sink.flush()
+        self._io += 1
+        return self._read()
 
 
     def _output(self, output):
         """
         Output a string without a newline appended.
         """
-        global online
-        global out
         output = str(output)
-        if online:
-           out[1] += output
-        else:
-            self._newline = output.endswith("\n")
-            sys.stdout.write(output)
-            sys.stdout.flush()
+        self._newline = output.endswith("\n")
+        self._io += 1
+        self._sink.write(output)
+
+
+def _wrap64(value):
+    # wrap an integer around to a signed 64-bit integer
+    return (value + 2**63) % 2**64 - 2**63
+
+
+def _pack_value(value):
+    # a stack or register value: an integer of any size, a float, or the
+    # digits read so far in regin mode
+    if isinstance(value, float):
+        return b"f" + struct.pack("<d", value)
+    if isinstance(value, str):
+        return b"s" + _pack_string(value)
+    length = (value.bit_length() + 8) // 8
+    return b"i" + struct.pack("<I", length) + value.to_bytes(length, "little", signed=True)
+
+
+def _unpack_value(data, offset):
+    if data[offset:offset + 1] == b"f":
+        return struct.unpack_from("<d", data, offset + 1)[0], offset + 9
+    if data[offset:offset + 1] == b"s":
+        return _unpack_string(data, offset + 1)
+    if data[offset:offset + 1] != b"i":
+        raise ValueError("Invalid snapshot")
+    length, = struct.unpack_from("<I", data, offset + 1)
+    offset += 5
+    if offset + length > len(data):
+        raise ValueError("Truncated snapshot")
+    return int.from_bytes(data[offset:offset + length], "little", signed=True), offset + length
+
+
+def _pack_string(string):
+    data = string.encode("utf-8", "surrogatepass")
+    return struct.pack("<I", len(data)) + data
+
+
+def _unpack_string(data, offset):
+    length, = struct.unpack_from("<I", data, offset)
+    offset += 4
+    if offset + length > len(data):
+        raise ValueError("Truncated snapshot")
+    return data[offset:offset + length].decode("utf-8", "surrogatepass"), offset + length
 
 
 class StopExecution(Exception):
@@ -495,29 +1282,1211 @@ class StopExecution(Exception):
     def __init__(self, message = None):
         self.message = message
 
-def execute(code, flags, input_list, output_var):
-    global out
-    global online
-    global inputs
+
+class AwaitingInput(Exception):
+    """
+    Exception raised when a script needs input that isn't available yet.
+    """
+
+
+class ValueTooLarge(Exception):
+    """
+    Exception raised when an integer grows past Interpreter._max_bits bits.
+    """
+
+
+class FastForward(Exception):
+    """
+    Exception raised by { and } inside _execute() when they close a loop
+    that can be skipped ahead through, for _execute() to decide how far.
+    """
+    def __init__(self, summary, count):
+        self.summary = summary
+        # the iterations before the one leaving the loop, or None if it
+        # never leaves
+        self.count = count
+
+
+class LoopSummary:
+    """
+    What one trip around a counting loop does, as found by
+    Interpreter._summarise_loop(), so that many trips can be applied at once.
+    """
+    def __init__(self, length, depth, updates, steps, test):
+        """
+        Arguments:
+            length -- the moves in one trip
+            depth -- the stack values it reads
+            updates -- each variable's new value, as (variable, constant)
+            steps -- how much each counter changes by per trip
+            test -- the value the { or } tests at the end of a trip
+        """
+        self.length = length
+        self.depth = depth
+        self.updates = updates
+        self.steps = steps
+        self.test = test
+
+    def iterations(self, interpreter):
+        """
+        Return the number of trips the interpreter makes before the one that
+        leaves the loop, or None if it never leaves. Returns 0 as well if the
+        stack is too shallow for the summary to hold.
+        """
+        if len(interpreter._stack) < self.depth:
+            return 0
+        source, value = self.test
+        if source is None:
+            return None
+        # the test is source + value on the first trip, and moves on by the
+        # source's step every trip after that
+        first = _variable(interpreter, source) + value
+        step = self.steps[source]
+        if not first:
+            return 0
+        if not step:
+            return None
+        count, remainder = divmod(-first, step)
+        return count if not remainder and count >= 0 else None
+
+    def apply(self, interpreter, count):
+        """
+        Make count trips around the loop in one go.
+        """
+        values = {}
+        for variable, (source, value) in self.updates.items():
+            if source is None:
+                values[variable] = value
+            elif source == variable:
+                values[variable] = _variable(interpreter, variable) + count * value
+            else:
+                # a copy of where a counter was a trip before
+                values[variable] = _variable(interpreter, source) + (count - 1) * self.steps[source] + value
+        stack = interpreter._stack
+        for variable, value in values.items():
+            if variable:
+                stack[-variable] = value
+            else:
+                interpreter._register = value
+
+
+def _variable(interpreter, variable):
+    # the register, or a value counted from the top of the stack
+    return interpreter._stack[-variable] if variable else interpreter._register
+
+class TraceInterpreter(Interpreter):
+    """
+    Grok interpreter which compiles straight-line paths through the wordbox
+    into Python functions the first time they are run.
+
+    The wordbox never changes, so everything from a given position and
+    direction up to the next instruction that depends on runtime values
+    ({, }, :, q or a string mode switch) always does the same thing. Those
+    paths are compiled once, cached by their entry state, and then run as a
+    single call instead of one move() per cell.
+    """
+    def __init__(self, code, output=None, input=None, int64=False):
+        super().__init__(code, output, input, int64)
+        self._traces = {}
+
+    def move(self):
+        """
+        Run the compiled path leaving the current position, or fall back to a
+        single step when no path can be compiled from here.
+        """
+        if self._string_mode is None and not self._skip:
+            key = (self._position[0], self._position[1], self._direction)
+            try:
+                trace = self._traces[key]
+            except KeyError:
+                trace = self._traces[key] = self._compile_trace(*key)
+            if trace is not None:
+                try:
+                    trace()
+                except (StopExecution, ValueTooLarge):
+                    raise
+                except KeyboardInterrupt:
+                    # avoid catching as error
+                    raise KeyboardInterrupt
+                except Exception:
+                    if self._debug:
+                        raise
+                    raise StopExecution("You don't grok Grok.")
+                self._steps += trace.steps
+                return
+        return Interpreter.move(self)
+
+    def _execute(self, max_steps):
+        """
+        Execute up to max_steps steps, running whole traces whenever they fit
+        in the remaining budget.
+        """
+        traces = self._traces
+        step = Interpreter.move
+        max_steps += self._steps
+        while self._steps < max_steps:
+            if self._string_mode is None and not self._skip:
+                key = (self._position[0], self._position[1], self._direction)
+                try:
+                    trace = traces[key]
+                except KeyError:
+                    trace = traces[key] = self._compile_trace(*key)
+                if trace is not None and self._steps + trace.steps <= max_steps:
+                    trace()
+                    self._steps += trace.steps
+                    continue
+            step(self)
+
+    def _compile_trace(self, x, y, direction):
+        """
+        Compile the path leaving (x, y) in the given direction into a function.
+        Returns None if the very first instruction has to go through move().
+        If an instruction on the path stops it, the function leaves the
+        position, direction and steps as they are after that instruction,
+        like move() does.
+        """
+        lines = []
+        # (x, y, direction, cells so far) at each instruction that can stop
+        # the path, which sets `at` to its index before it runs
+        stops = []
+        namespace = {"self": self, "push": self._push, "pop": self._pop,
+                     "instructions": self._instructions, "stops": stops,
+                     "stopped": self._stopped, "ValueTooLarge": ValueTooLarge}
+        # stop when the path loops back on itself, so that each loop iteration
+        # is one call to a cached trace
+        seen = set()
+        cells = 0
+        while len(lines) < MAX_TRACE_LENGTH:
+            next_x, next_y = self._advance(x, y, direction)
+            instruction = self._cell(next_x, next_y)
+            if ((next_x, next_y, direction) in seen or instruction in TRACE_BARRIERS
+                    or instruction not in self._instructions):
+                break
+            seen.add((next_x, next_y, direction))
+            x, y = next_x, next_y
+            cells += 1
+
+            if instruction in DIRECTIONS:
+                direction = DIRECTIONS[instruction]
+                continue
+            elif instruction == "`":
+                # the skipped cell is never executed, so step over it right away
+                x, y = self._advance(x, y, direction)
+                cells += 1
+                continue
+            elif instruction in NCHARS:
+                lines.append("push({})".format(instruction))
+                continue
+            elif instruction == " ":
+                continue
+
+            lines.append("at = {}".format(len(stops)))
+            stops.append((x, y, direction, cells))
+            if instruction in ARITHMETIC:
+                operation = ARITHMETIC[instruction]
+                namespace[operation.__name__] = operation
+                lines.append("a = pop(); push({}(pop(), a))".format(operation.__name__))
+                if self._max_bits is not None:
+                    lines[-1] = "a = pop(); a = {}(pop(), a); push(a)".format(operation.__name__)
+                    lines.append("if type(a) is int and a.bit_length() > {}: raise ValueTooLarge()".format(
+                        self._max_bits))
+            elif instruction in COMPARISON:
+                operation = COMPARISON[instruction]
+                namespace[operation.__name__] = operation
+                lines.append("a = pop(); push(1 if {}(pop(), a) else 0)".format(operation.__name__))
+            else:
+                lines.append("instructions[{!r}]()".format(instruction))
+
+        if not cells:
+            return None
+        lines.append("self._position[0] = {}".format(x))
+        lines.append("self._position[1] = {}".format(y))
+        lines.append("self._direction = {}".format(direction))
+        if stops:
+            lines = (["try:"] + ["    " + line for line in lines] +
+                     ["except BaseException:", "    stopped(*stops[at])", "    raise"])
+        source = "def trace():\n" + "".join("    {}\n".format(line) for line in lines)
+        exec(compile(source, "<trace>", "exec"), namespace)
+        trace = namespace["trace"]
+        trace.steps = cells
+        return trace
+
+    def _stopped(self, x, y, direction, steps):
+        """
+        Leave a trace at (x, y), where one of its instructions stopped it,
+        counting the steps up to there.
+        """
+        self._position[0] = x
+        self._position[1] = y
+        self._direction = direction
+        self._steps += steps
+
+
+class Profiler:
+    """
+    Statistics about where a script spends its steps, collected by
+    ProfilingInterpreter.
+    """
+    def __init__(self, wordbox):
+        """
+        Arguments:
+            wordbox -- the rows of the script being profiled
+        """
+        self._wordbox = wordbox
+        # hits per (x, y) cell, and per (x, y, direction) arrival
+        self.cells = Counter()
+        self.directions = Counter()
+        # how often each instruction was executed
+        self.instructions = Counter()
+        self.steps = 0
+        self.seconds = 0.0
+        self.max_stack_depth = 0
+
+    def _cell(self, x, y):
+        return self._wordbox[y][x] if 0 <= x < len(self._wordbox[y]) else " "
+
+    def steps_per_second(self):
+        return self.steps / self.seconds if self.seconds else 0.0
+
+    def report(self, top=10):
+        """
+        Return a human-readable summary, listing the top hottest cells.
+        """
+        lines = [
+            "Steps: {} ({:.3f} seconds, {:.0f} steps per second)".format(
+                self.steps, self.seconds, self.steps_per_second()),
+            "Max stack depth: {}".format(self.max_stack_depth),
+            "Instructions:",
+        ]
+        for instruction, hits in self.instructions.most_common():
+            lines.append("    {!r:6} {}".format(instruction, hits))
+        lines.append("Hottest cells:")
+        for (x, y), hits in self.cells.most_common(top):
+            per_direction = ", ".join("{}: {}".format(name, self.directions[(x, y, name)])
+                                      for name in DIRECTIONS if self.directions[(x, y, name)])
+            lines.append("    ({}, {}) {!r:6} {} ({})".format(x, y, self._cell(x, y), hits, per_direction))
+        return "\n".join(lines)
+
+    def to_json(self):
+        """
+        Return the profile as JSON, including a grid of hit counts with the
+        same shape as the wordbox for drawing heatmaps.
+        """
+        import json
+        return json.dumps({
+            "steps": self.steps,
+            "seconds": self.seconds,
+            "steps_per_second": self.steps_per_second(),
+            "max_stack_depth": self.max_stack_depth,
+            "instructions": dict(self.instructions),
+            "heatmap": [[self.cells[(x, y)] for x in range(len(row))] for y, row in enumerate(self._wordbox)],
+            "cells": [{"x": x, "y": y, "instruction": self._cell(x, y), "hits": hits,
+                       "directions": {name: self.directions[(x, y, name)]
+                                      for name in DIRECTIONS if self.directions[(x, y, name)]}}
+                      for (x, y), hits in sorted(self.cells.items(), key=lambda item: item[0][::-1])],
+        })
+
+    def to_csv(self):
+        """
+        Return the hit counts of every visited cell as CSV.
+        """
+        import csv
+        import io
+        output = io.StringIO()
+        writer = csv.writer(output, lineterminator="\n")
+        writer.writerow(["x", "y", "instruction", "hits"] + ["hits_" + name for name in DIRECTIONS])
+        for (x, y), hits in sorted(self.cells.items(), key=lambda item: item[0][::-1]):
+            writer.writerow([x, y, self._cell(x, y), hits] +
+                            [self.directions[(x, y, name)] for name in DIRECTIONS])
+        return output.getvalue()
+
+
+class ProfilingInterpreter(Interpreter):
+    """
+    Grok interpreter which records a Profiler of everything it executes. The
+    bookkeeping lives here rather than in Interpreter, so that scripts run
+    without profiling don't pay for it.
+    """
+    def __init__(self, code, output=None, input=None, int64=False):
+        super().__init__(code, output, input, int64)
+        self._profile = Profiler(self._wordbox)
+
+    def _execute(self, max_steps):
+        """
+        Execute up to max_steps steps one move() at a time, recording each.
+        """
+        profile = self._profile
+        position = self._position
+        names = {direction: name for name, direction in DIRECTIONS.items()}
+        start = time.perf_counter()
+        steps = 0
+        try:
+            while steps < max_steps:
+                steps += 1
+                direction = self._direction
+                instruction = None
+                try:
+                    instruction = self.move()
+                except Exception:
+                    # the instruction that stopped the script
+                    instruction = self._cell(position[0], position[1])
+                    raise
+                finally:
+                    cell = (position[0], position[1])
+                    profile.cells[cell] += 1
+                    profile.directions[cell + (names[direction],)] += 1
+                    if instruction is not None:
+                        profile.instructions[instruction] += 1
+                    if len(self._stack) > profile.max_stack_depth:
+                        profile.max_stack_depth = len(self._stack)
+        finally:
+            profile.steps += steps
+            profile.seconds += time.perf_counter() - start
+
+
+class Recorder:
+    """
+    Writes everything a RecordingInterpreter does to a recording, one chunk
+    of steps at a time, which Recording can then seek through.
+
+    Each step pushes at most one value after popping the ones it needs,
+    except for insert mode strings and input, which only push. So a step is
+    recorded as the height of the stack after it, times 8, plus what became
+    of the top value: 0 if it stayed the same, 1 if it changed to the next
+    one recorded, 2 if the register was pushed, 3 if it is the result of an
+    arithmetic instruction too long for 64 bits, which replaying works out
+    again, or 4 if values were only popped. The values pushed by the steps that push more than one are
+    recorded too. The direction and register are recorded when they change,
+    the register as the value it was copied from on the stack if it is too
+    long for 64 bits, as are the steps that skipped their cell; the
+    positions and instructions follow from those and the script. Loops are
+    skipped ahead through like Interpreter._execute() does, recording the
+    moves skipped after the { or } that closes them.
+    Chunks are compressed, and the first of them, and any written after
+    RECORD_SNAPSHOT_RATIO times as much as the last snapshot took up, start
+    with a snapshot of the whole state to replay from.
+    """
+    def __init__(self, file, code):
+        """
+        Arguments:
+            file -- a binary file to write the recording to
+            code -- the script being recorded
+        """
+        self._file = file
+        file.write(RECORDING_MAGIC + bytes([RECORDING_VERSION]) + _pack_string(code))
+        # (first step, offset, has a snapshot) of each chunk written
+        self._index = []
+        # the steps recorded one by one and the bytes written since the last
+        # snapshot, and its size, or None before the first, and the first
+        # step of the chunk being recorded, or None if none is
+        self._records = 0
+        self._written = 0
+        self._snapshot_size = None
+        self._first = None
+        self._snapshot = b""
+        # the top of the stack as last recorded
+        self._top = None
+        # the stack height after each step of the chunk, times 8, plus what
+        # became of the top value, and the new top values. these are cleared
+        # in place, so RecordingInterpreter can hold on to their methods
+        self.heights = []
+        self.tops = []
+        # the steps within the chunk that skipped their cell, and those that
+        # pushed more than one value, with the values
+        self.skips = []
+        self.pushed_steps = []
+        self.pushed = []
+        # the steps within the chunk that changed the direction and the
+        # register, with their new values, and those that copied a value
+        # from the stack to the register, with how far down it was
+        self.direction_steps = []
+        self.directions = []
+        self.register_steps = []
+        self.registers = []
+        self.copy_steps = []
+        self.copy_depths = []
+        # the steps within the chunk that skipped ahead through a loop, with
+        # the number of moves skipped
+        self.forward_steps = []
+        self.forward_moves = []
+
+    def begin(self, interpreter, snapshot=False):
+        """
+        Start a chunk at the interpreter's current state, including a
+        snapshot if asked to, or if enough has been written since the last
+        one to make up for it.
+        """
+        stack = interpreter._stack
+        if (snapshot or self._snapshot_size is None or
+                self._records >= RECORD_CHUNK_STEPS and
+                self._written >= RECORD_SNAPSHOT_RATIO * self._snapshot_size):
+            self._snapshot = interpreter.snapshot()
+            self._records = 0
+            self._written = 0
+            self._snapshot_size = len(self._snapshot)
+            self._top = stack[-1] if stack else None
+        else:
+            self._snapshot = b""
+        self._first = interpreter._steps
+
+    def end(self):
+        """
+        Write the chunk being recorded, if any.
+        """
+        if self._first is None:
+            return
+        records = len(self.heights)
+        self._records += records
+        if records or self._snapshot:
+            columns = [array("I", self.heights),
+                       array("I", self.skips),
+                       array("I", self.pushed_steps),
+                       array("I", [len(values) for values in self.pushed]),
+                       array("I", self.direction_steps),
+                       array("B", self.directions),
+                       array("I", self.register_steps),
+                       array("I", self.copy_steps),
+                       array("B", self.copy_depths),
+                       array("I", self.forward_steps),
+                       array("Q", self.forward_moves)]
+            if sys.byteorder == "big":
+                for column in columns:
+                    column.byteswap()
+            data = b"".join(struct.pack("<I", len(column) * column.itemsize) + column.tobytes() for column in columns)
+            data += (_pack_values(self.tops) + _pack_values([value for values in self.pushed for value in values]) +
+                     _pack_values(self.registers))
+            data = zlib.compress(data, 1)
+            self._written += len(data)
+            self._index.append((self._first, self._file.tell(), bool(self._snapshot)))
+            # the chunk's steps, counting the moves skipped
+            count = records + sum(self.forward_moves)
+            self._file.write(struct.pack("<QQII", self._first, count, len(self._snapshot), len(data)))
+            self._file.write(self._snapshot)
+            self._file.write(data)
+        for column in (self.heights, self.tops, self.skips, self.pushed_steps, self.pushed,
+                       self.direction_steps, self.directions, self.register_steps, self.registers,
+                       self.copy_steps, self.copy_depths, self.forward_steps, self.forward_moves):
+            del column[:]
+        self._first = None
+
+    def close(self):
+        """
+        Write the last chunk and the index, and close the file.
+        """
+        self.end()
+        offset = self._file.tell()
+        for first, chunk, snapshot in self._index:
+            self._file.write(struct.pack("<QQB", first, chunk, snapshot))
+        self._file.write(struct.pack("<QQ", offset, len(self._index)) + RECORDING_MAGIC)
+        self._file.close()
+
+
+def _pack_values(values):
+    # stack or register values, copied in one go if they are all integers
+    # that fit in 64 bits
+    try:
+        column = array("q", values)
+    except (TypeError, OverflowError):
+        return b"v" + b"".join(_pack_value(value) for value in values)
+    if sys.byteorder == "big":
+        column.byteswap()
+    return b"q" + column.tobytes()
+
+
+def _unpack_values(data, offset, count):
+    if data[offset:offset + 1] == b"q":
+        offset += 1
+        column = array("q")
+        column.frombytes(data[offset:offset + count * 8])
+        if len(column) != count:
+            raise ValueError("Truncated recording")
+        if sys.byteorder == "big":
+            column.byteswap()
+        return column.tolist(), offset + count * 8
+    if data[offset:offset + 1] != b"v":
+        raise ValueError("Invalid recording")
+    offset += 1
+    values = []
+    for _ in range(count):
+        value, offset = _unpack_value(data, offset)
+        values.append(value)
+    return values, offset
+
+
+class RecordingInterpreter(Interpreter):
+    """
+    Grok interpreter which records every step it executes to a Recorder, so
+    that any step of the run can be looked at afterwards without running the
+    script again. Like ProfilingInterpreter, the bookkeeping lives here so
+    that scripts run without recording don't pay for it.
+    """
+    def __init__(self, code, recorder, output=None, input=None, int64=False):
+        super().__init__(code, output, input, int64)
+        self._recorder = recorder
+
+    def run(self, max_steps=None):
+        """
+        Execute up to max_steps steps, like Interpreter.run().
+        """
+        if self._awaiting_input:
+            # the input retried by run() changes the stack outside of a step,
+            # so the next chunk has to start from a snapshot taken after it
+            self._recorder.end()
+        return super().run(max_steps)
+
+    def restore(self, snapshot):
+        """
+        Continue from a snapshot, like Interpreter.restore().
+        """
+        super().restore(snapshot)
+        self._recorder.end()
+
+    def _execute(self, max_steps):
+        """
+        Execute up to max_steps steps, recording each, or the moves skipped
+        for loops. This does the same as Interpreter._execute().
+        """
+        recorder = self._recorder
+        if recorder._first is None:
+            recorder.begin(self, snapshot=True)
+        wordbox = self._wordbox
+        widths = self._widths
+        height = self._height
+        position = self._position
+        handle_instruction = self._handle_instruction
+        nop_runs = self._nop_runs
+        heights = recorder.heights
+        record = heights.append
+        record_top = recorder.tops.append
+        numbers = {direction: number for number, direction in enumerate(DIRECTIONS.values())}
+        stack = self._stack
+        top = recorder._top
+        chunk_steps = RECORD_CHUNK_STEPS
+        steps = 0
+        self._fast_forward = self._summarise_loops
+        try:
+            while steps < max_steps:
+                steps += 1
+                direction = self._direction
+                register = self._register
+                before = len(stack)
+                x = position[0] + direction[0]
+                y = position[1] + direction[1]
+                if y >= height:
+                    y = 0
+                elif y < 0:
+                    y = height - 1
+                width = widths[y]
+                if direction[0] == 1 and x >= width:
+                    x = 0
+                elif x < 0:
+                    x = width - 1
+                position[0] = x
+                position[1] = y
+
+                if self._skip:
+                    self._skip = False
+                    recorder.skips.append(len(heights))
+                    record(before << 3)
+                    continue
+                instruction = wordbox[y][x] if 0 <= x < width else " "
+                if instruction == " " and self._string_mode is None:
+                    # jump over the rest of the spaces, none of which change
+                    # anything, like Interpreter._execute() does
+                    key = (x, y, direction)
+                    try:
+                        run = nop_runs[key]
+                    except KeyError:
+                        run = nop_runs[key] = self._nop_run(x, y, direction)
+                    moves = 0
+                    if run is not None and steps + run[2] <= max_steps:
+                        position[0], position[1], moves = run
+                        steps += moves
+                    heights.extend([before << 3] * (moves + 1))
+                else:
+                    loop = None
+                    try:
+                        handle_instruction(instruction)
+                    except FastForward as forward:
+                        loop = forward
+                    finally:
+                        # record the step even if it stopped the script, so
+                        # that the recording ends in the state it stopped in
+                        after = len(stack)
+                        if after and stack[-1] is not top:
+                            top = stack[-1]
+                            if after < before and instruction in RECORD_POPS:
+                                record(after << 3 | 4)
+                            elif top is register:
+                                record(after << 3 | 2)
+                            elif type(top) is int and not -2**63 <= top < 2**63 and instruction in ARITHMETIC:
+                                record(after << 3 | 3)
+                            else:
+                                record(after << 3 | 1)
+                                record_top(top)
+                        else:
+                            record(after << 3)
+                        if after - before > 1:
+                            # a string or input, which only pushes
+                            recorder.pushed_steps.append(len(heights) - 1)
+                            recorder.pushed.append(stack[before:])
+                        if self._register is not register:
+                            value = self._register
+                            depth = 0
+                            if type(value) is int and not -2**63 <= value < 2**63:
+                                for depth in range(1, min(after, RECORD_COPY_DEPTH) + 1):
+                                    if stack[-depth] is value:
+                                        break
+                                else:
+                                    depth = 0
+                            if depth:
+                                recorder.copy_steps.append(len(heights) - 1)
+                                recorder.copy_depths.append(depth)
+                            else:
+                                recorder.register_steps.append(len(heights) - 1)
+                                recorder.registers.append(value)
+                        if self._direction is not direction:
+                            recorder.direction_steps.append(len(heights) - 1)
+                            recorder.directions.append(numbers[self._direction])
+                    if loop is not None:
+                        # skip the iterations that fit in the remaining steps,
+                        # like Interpreter._execute()
+                        count = loop.count
+                        if max_steps != float("inf"):
+                            fit = int(max_steps - steps) // loop.summary.length
+                            count = fit if count is None else min(count, fit)
+                        if count:
+                            loop.summary.apply(self, count)
+                            steps += count * loop.summary.length
+                            recorder.forward_steps.append(len(heights) - 1)
+                            recorder.forward_moves.append(count * loop.summary.length)
+                            top = stack[-1] if stack else None
+                if len(heights) >= chunk_steps:
+                    # bring the step count up to date for the snapshot
+                    self._steps += steps
+                    max_steps -= steps
+                    steps = 0
+                    recorder._top = top
+                    recorder.end()
+                    recorder.begin(self)
+                    top = recorder._top
+        finally:
+            self._steps += steps
+            self._fast_forward = False
+            recorder._top = top
+
+
+class RecordedState:
+    """
+    The state of a recorded run after a given step, as returned by
+    Recording.state().
+    """
+    def __init__(self, step, position, direction, instruction, stack, register):
+        self.step = step
+        self.position = position
+        self.direction = direction
+        # the instruction at the step's cell, or None if the step skipped it
+        # or there was no step
+        self.instruction = instruction
+        self.stack = stack
+        self.register = register
+
+
+class Recording:
+    """
+    A recording written by Recorder, which can show the state after any of
+    its steps. The chunk the step is in, and the snapshot to start from, are
+    found with a binary search, so only the steps from there on are replayed.
+    """
+    def __init__(self, file):
+        """
+        Arguments:
+            file -- the recording, as a binary file opened for reading
+        Raises ValueError if the file isn't a recording.
+        """
+        self._file = file
+        header = len(RECORDING_MAGIC) + 1
+        data = file.read(header + 4)
+        if data[:header] != RECORDING_MAGIC + bytes([RECORDING_VERSION]):
+            raise ValueError("Not a recording of this version")
+        try:
+            length, = struct.unpack_from("<I", data, header)
+            self.code = file.read(length).decode("utf-8", "surrogatepass")
+        except (struct.error, UnicodeDecodeError) as e:
+            raise ValueError("Invalid recording") from e
+        # restores the snapshots, follows the path between them and runs
+        # the part of a loop a step stopped in
+        self._interpreter = Interpreter(self.code, input=online_input(""))
+        self._interpreter._summarise_loops = False
+
+        # (first step, offset, has a snapshot) of each chunk
+        start = file.tell()
+        index = None
+        footer = struct.calcsize("<QQ") + len(RECORDING_MAGIC)
+        end = file.seek(0, os.SEEK_END)
+        if end - start >= footer:
+            file.seek(end - footer)
+            data = file.read(footer)
+            if data.endswith(RECORDING_MAGIC):
+                offset, count = struct.unpack_from("<QQ", data)
+                file.seek(offset)
+                entry = struct.calcsize("<QQB")
+                data = file.read(count * entry)
+                if len(data) == count * entry:
+                    index = [struct.unpack_from("<QQB", data, number * entry) for number in range(count)]
+        if index is None:
+            # the run was killed before the index was written, so find the
+            # chunks that made it by reading them one by one
+            index = []
+            offset = start
+            chunk = struct.calcsize("<QQII")
+            while offset + chunk <= end:
+                file.seek(offset)
+                first, count, snapshot, length = struct.unpack("<QQII", file.read(chunk))
+                # each chunk carries on from the one before, so that the
+                # index left behind isn't taken for one
+                if offset + chunk + snapshot + length > end or (index and first != index[-1][0] + steps):
+                    break
+                index.append((first, offset, snapshot > 0))
+                offset += chunk + snapshot + length
+                steps = count
+        if not index or not index[0][2]:
+            raise ValueError("Empty recording")
+        self._firsts = [first for first, _, _ in index]
+        self._offsets = [offset for _, offset, _ in index]
+        self._snapshots = [number for number, (_, _, snapshot) in enumerate(index) if snapshot]
+        # the steps the recording goes from and to
+        self.first = self._firsts[0]
+        self.last = self._firsts[-1] + self._read(len(index) - 1)[0]
+
+    def state(self, step):
+        """
+        Return a RecordedState of the run after the given step. Raises
+        IndexError if the step wasn't recorded.
+        """
+        if not self.first <= step <= self.last:
+            raise IndexError("Step {} wasn't recorded".format(step))
+        # the chunk the step is in, counting a step at the end of a chunk as
+        # in it rather than the next
+        target = max(bisect_left(self._firsts, step) - 1, 0)
+        chunk = self._snapshots[bisect_right(self._snapshots, target) - 1]
+
+        interpreter = self._interpreter
+        count, snapshot, data = self._read(chunk)
+        interpreter.restore(snapshot)
+        stack = list(interpreter._stack)
+        register = interpreter._register
+        direction = interpreter._direction
+        x, y = interpreter._position
+        top = stack[-1] if stack else None
+        instruction = None
+        directions = tuple(DIRECTIONS.values())
+        while True:
+            steps = min(count, step - self._firsts[chunk])
+            (heights, skips, pushed_steps, pushed_counts, direction_steps, new_directions, register_steps,
+             copy_steps, copy_depths, forward_steps, forward_moves), tops, pushed, registers = _unpack_chunk(data, count)
+            # the next of each of the changes to look out for
+            changes = [0] * 8
+            number = 0
+            while steps > 0:
+                steps -= 1
+                x, y = interpreter._advance(x, y, direction)
+                kind = heights[number] & 7
+                height = heights[number] >> 3
+                if kind == 1:
+                    top = tops[changes[0]]
+                    changes[0] += 1
+                elif kind == 2:
+                    top = register
+                elif kind == 3:
+                    top = _recompute(interpreter._cell(x, y), stack)
+                elif kind == 4:
+                    top = stack[height - 1]
+                if changes[1] < len(pushed_steps) and pushed_steps[changes[1]] == number:
+                    stack.extend(pushed[changes[2]:changes[2] + pushed_counts[changes[1]]])
+                    changes[2] += pushed_counts[changes[1]]
+                    changes[1] += 1
+                elif height:
+                    del stack[height - 1:]
+                    stack.append(top)
+                else:
+                    del stack[:]
+                if changes[3] < len(register_steps) and register_steps[changes[3]] == number:
+                    register = registers[changes[3]]
+                    changes[3] += 1
+                elif changes[6] < len(copy_steps) and copy_steps[changes[6]] == number:
+                    register = stack[-copy_depths[changes[6]]]
+                    changes[6] += 1
+                if changes[4] < len(direction_steps) and direction_steps[changes[4]] == number:
+                    direction = directions[new_directions[changes[4]]]
+                    changes[4] += 1
+                skipped = changes[5] < len(skips) and skips[changes[5]] == number
+                if skipped:
+                    changes[5] += 1
+                instruction = None if skipped else interpreter._cell(x, y)
+                if changes[7] < len(forward_steps) and forward_steps[changes[7]] == number:
+                    moves = min(forward_moves[changes[7]], steps)
+                    changes[7] += 1
+                    steps -= moves
+                    x, y, direction, register, instruction = self._forward(stack, register, x, y, direction, moves)
+                    top = stack[-1] if stack else None
+                number += 1
+            if chunk == target:
+                break
+            chunk += 1
+            count, _, data = self._read(chunk)
+        return RecordedState(step, (x, y), direction, instruction, stack, register)
+
+    def _forward(self, stack, register, x, y, direction, moves):
+        """
+        Make the given number of moves around the loop closed by the { or }
+        at (x, y), which the recording skipped ahead through, updating the
+        stack in place. Returns the new position, direction and register, and
+        the instruction executed last.
+        """
+        interpreter = self._interpreter
+        key = (x, y, direction)
+        try:
+            summary = interpreter._loops[key]
+        except KeyError:
+            summary = interpreter._loops[key] = interpreter._summarise_loop(*key)
+        trips, moves = divmod(moves, summary.length)
+        interpreter._stack = stack
+        interpreter._register = register
+        summary.apply(interpreter, trips)
+        if not moves:
+            return x, y, direction, interpreter._register, interpreter._cell(x, y)
+        # part of a trip, which only counts, so it can simply be run
+        interpreter._position = [x, y]
+        interpreter._direction = direction
+        interpreter._string_mode = None
+        interpreter._num_entered = False
+        interpreter._insert_string = ""
+        interpreter._skip = False
+        interpreter._halted = False
+        interpreter._awaiting_input = False
+        interpreter.run(moves - 1)
+        skipped = interpreter._skip
+        interpreter.run(1)
+        x, y = interpreter._position
+        return x, y, interpreter._direction, interpreter._register, None if skipped else interpreter._cell(x, y)
+
+    def _read(self, chunk):
+        """
+        Return the number of steps in a chunk, its snapshot (or b"") and its
+        compressed steps.
+        """
+        file = self._file
+        file.seek(self._offsets[chunk])
+        try:
+            _, count, snapshot, length = struct.unpack("<QQII", file.read(struct.calcsize("<QQII")))
+        except struct.error as e:
+            raise ValueError("Truncated recording") from e
+        return count, file.read(snapshot), file.read(length)
+
+
+def _recompute(instruction, stack):
+    # the result of an arithmetic instruction, from the stack before it. it
+    # is an integer, so it was worked out from integers, which _pop() turns
+    # whole floats into
+    a = stack[-1] if stack else 0
+    b = stack[-2] if len(stack) > 1 else 0
+    return ARITHMETIC[instruction](int(b), int(a))
+
+
+def _unpack_chunk(data, count):
+    # the columns of a chunk written by Recorder.end(), and the top values,
+    # the values pushed by strings and input, and the register values
+    try:
+        data = zlib.decompress(data)
+        columns = []
+        offset = 0
+        for typecode in "IIIIIBIIBIQ":
+            length, = struct.unpack_from("<I", data, offset)
+            offset += 4
+            column = array(typecode)
+            column.frombytes(data[offset:offset + length])
+            if sys.byteorder == "big":
+                column.byteswap()
+            columns.append(column)
+            offset += length
+        tops, offset = _unpack_values(data, offset, sum(height & 7 == 1 for height in columns[0]))
+        pushed, offset = _unpack_values(data, offset, sum(columns[3]))
+        registers, offset = _unpack_values(data, offset, len(columns[6]))
+    except (zlib.error, struct.error, IndexError) as e:
+        raise ValueError("Invalid recording") from e
+    if len(columns[0]) + sum(columns[10]) != count:
+        raise ValueError("Invalid recording")
+    return columns, tops, pushed, registers
+
+
+class Transpiler:
+    """
+    Translate a Grok script into a standalone Python module.
+
+    Only the stack and input can influence control flow, and they only do so
+    at { and }. Everything between two such branches, including string modes,
+    is decided by position and direction alone, so each reachable path is
+    compiled into one Python function (a block) that returns the number of
+    the block to run next. The generated code calls the same handlers as
+    Interpreter, so both engines share their semantics.
+    """
+    # returned in place of an instruction when a string mode never ends
+    _UNTERMINATED = object()
+
+    def __init__(self, code, int_div=False):
+        """
+        Arguments:
+            code -- the code to translate as a string
+            int_div -- compile division as integer division
+        """
+        self._wordbox = Interpreter(code)
+        self._int_div = int_div
+        self._blocks = {}
+        self._pending = []
+
+    def transpile(self):
+        """
+        Return the source code of the translated module.
+        """
+        start = self._block(-1, 0, DIRECTIONS["l"])
+        functions = []
+        while self._pending:
+            state = self._pending.pop(0)
+            lines = self._compile_block(*state)
+            functions.append("    def block_{}():\n".format(self._blocks[state]) +
+                             "".join("        {}\n".format(line) for line in lines))
+
+        return "".join([
+            '"""\nCompiled Grok script, generated by PyGrok.py --compile. Do not edit.\n"""\n\n',
+            "def run(interpreter):\n",
+            "    push = interpreter._push\n",
+            "    pop = interpreter._pop\n",
+            "    instructions = interpreter._instructions\n\n",
+            "\n".join(functions), "\n",
+            "    blocks = ({},)\n".format(", ".join("block_{}".format(n) for n in range(len(self._blocks)))),
+            "    block = {}\n".format(start),
+            "    while True:\n",
+            "        block = blocks[block]()\n",
+        ])
+
+    def _block(self, x, y, direction):
+        """
+        Return the number of the block leaving (x, y) in the given direction,
+        queueing it to be compiled if it hasn't been seen before.
+        """
+        state = (x, y, direction)
+        if state not in self._blocks:
+            self._blocks[state] = len(self._blocks)
+            self._pending.append(state)
+        return self._blocks[state]
+
+    def _compile_block(self, x, y, direction):
+        """
+        Return the lines of code for the block leaving (x, y) in the given
+        direction.
+        """
+        wordbox = self._wordbox
+        lines = []
+        # jump to a new block when the path loops back on itself
+        seen = set()
+        while True:
+            next_x, next_y = wordbox._advance(x, y, direction)
+            if (next_x, next_y, direction) in seen:
+                lines.append("return {}".format(self._block(x, y, direction)))
+                return lines
+            seen.add((next_x, next_y, direction))
+            x, y = next_x, next_y
+
+            instruction = wordbox._cell(x, y)
+            # regin mode ends by executing the first non-number it reads,
+            # which might start regin mode again
+            regins = set()
+            while instruction == "I":
+                if (x, y) in regins:
+                    instruction = self._UNTERMINATED
+                    break
+                regins.add((x, y))
+                x, y, instruction = self._regin(lines, x, y, direction)
+            if instruction == "i":
+                x, y, instruction = self._insert(lines, x, y, direction)
+
+            if instruction is None or instruction == " ":
+                pass
+            elif instruction is self._UNTERMINATED:
+                # a string that never ends, which runs forever without output
+                lines.append("while True:")
+                lines.append("    pass")
+                return lines
+            elif instruction == "`":
+                # the skipped cell is never executed
+                x, y = wordbox._advance(x, y, direction)
+            elif instruction in DIRECTIONS:
+                direction = DIRECTIONS[instruction]
+            elif instruction in "{}":
+                rotation = ROTATE_RIGHT if instruction == "}" else ROTATE_LEFT
+                lines.append("if pop():")
+                lines.append("    return {}".format(self._block(x, y, direction)))
+                lines.append("return {}".format(self._block(x, y, rotation[direction])))
+                return lines
+            elif instruction == "q":
+                lines.append("instructions['q']()")
+                return lines
+            elif instruction not in wordbox._instructions:
+                lines.append("raise Exception('Invalid instruction', {!r})".format(instruction))
+                return lines
+            elif instruction in NCHARS:
+                lines.append("push({})".format(instruction))
+            elif instruction in ARITHMETIC:
+                lines.append("a = pop(); push(pop() {} a)".format(instruction))
+            elif instruction in COMPARISON:
+                lines.append("a = pop(); push(1 if pop() {} a else 0)".format(
+                    "==" if instruction == "=" else instruction))
+            elif instruction == "/" and self._int_div:
+                lines.append("a = int(pop()); push(int(pop()) // a)")
+            else:
+                lines.append("instructions[{!r}]()".format(instruction))
+
+    def _insert(self, lines, x, y, direction):
+        """
+        Follow an insert mode string starting at (x, y) and emit the values it
+        pushes. Returns the position of the closing `, and None as there is
+        nothing left to execute there.
+        """
+        string = ""
+        seen = set()
+        while True:
+            x, y = self._wordbox._advance(x, y, direction)
+            instruction = self._wordbox._cell(x, y)
+            if instruction == "`":
+                break
+            if (x, y) in seen:
+                return x, y, self._UNTERMINATED
+            seen.add((x, y))
+            string += instruction
+
+        if not string:
+            # for empty string, push nothing
+            pass
+        elif all(char in NCHARS for char in string):
+            lines.append("push({})".format(int(string)))
+        else:
+            for char in string[::-1]:
+                lines.append("push({})".format(ord(char)))
+        return x, y, None
+
+    def _regin(self, lines, x, y, direction):
+        """
+        Follow a regin mode string starting at (x, y) and emit the register
+        value it sets. Returns the position where regin mode ended, and the
+        instruction that still has to be executed there (if any).
+        """
+        x, y = self._wordbox._advance(x, y, direction)
+        instruction = self._wordbox._cell(x, y)
+        if instruction == "`":
+            # regin escape, the following cell is skipped
+            return x, y, "`"
+        if instruction not in NCHARS:
+            lines.append("interpreter._register = {}".format(ord(instruction)))
+            return x, y, None
+
+        number = instruction
+        seen = {(x, y)}
+        while True:
+            x, y = self._wordbox._advance(x, y, direction)
+            instruction = self._wordbox._cell(x, y)
+            if instruction not in NCHARS:
+                break
+            if (x, y) in seen:
+                return x, y, self._UNTERMINATED
+            seen.add((x, y))
+            number += instruction
+        lines.append("interpreter._register = {}".format(int(number)))
+        return x, y, instruction
+
+
+def load_compiled(code, int_div=False, cache_dir=COMPILE_CACHE):
+    """
+    Return the compiled module for a Grok script, translating it first if it
+    isn't cached yet. Cached modules are keyed by a hash of the code and the
+    flags that change how it behaves, and Python keeps their bytecode next to
+    them, so later runs skip both parsing and translation.
+    Arguments:
+        code -- the code to compile as a string
+        int_div -- compile division as integer division
+        cache_dir -- the directory compiled modules are kept in
+    """
+    import hashlib
+    import importlib.util
+
+    key = "{}\0{}\0{}".format(COMPILER_VERSION, int(int_div), code)
+    name = "grok_" + hashlib.sha256(key.encode("utf-8", "surrogatepass")).hexdigest()[:32]
+    path = os.path.join(cache_dir, name + ".py")
+
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        # write to a temporary file first, so that a concurrent run never
+        # imports a half-written module
+        temp = "{}.{}.tmp".format(path, os.getpid())
+        with open(temp, "w", encoding="utf-8") as f:
+            f.write(Transpiler(code, int_div).transpile())
+        os.replace(temp, path)
+
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def execute(code, flags, input_list, output_var, stats=None):
     out = output_var
     out[1] = ""
     out[2] = ""
-    flags = flags
-    online = True
-    inputs = input_list.split("\n")
 
-    interpreter = Interpreter(code)
+    def write(chunk):
+        out[1] += chunk
+
+    def write_error(message):
+        out[2] += message
+
+    stream_execute(code, flags, input_list, write, write_error, stats=stats)
+
+
+def stream_execute(code, flags, input_list, write, write_error, max_steps=None, snapshot=None, stats=None):
+    """
+    Run a script for the online interpreter, passing its output on as it is
+    produced.
+    Arguments:
+        code -- the code to execute as a string
+        flags -- the online interpreter's flags
+        input_list -- the script's input, one line per ':' instruction, as a
+                      string or a list of lines
+        write -- a function called with each chunk of output
+        write_error -- a function called with the error message, if any
+        max_steps -- the number of steps the script may run for (default:
+                     unlimited)
+        snapshot -- a snapshot of the script to continue from, in which case
+                    input_list is the input it hasn't read yet
+        stats -- a dict to store the number of steps run and the time taken
+                 in seconds in, under "steps" and "seconds"
+    Returns HALTED if the script quit, ERROR if it stopped with an error, or
+    BUDGET_EXHAUSTED if it ran out of steps.
+    """
+    flags = flags or ""
+    # buffer output locally, as every write may be a round trip to another
+    # process
+    sink = OutputSink(write, FLUSH_SIZE)
+    interpreter = online_interpreter(code, flags, sink, online_input(input_list))
 
     if flags:
-        if 'd' in flags:
-            interpreter._int_div = True
-        if 'e' in flags:
-            interpreter._debug = True
         if 'h' in flags:
-            out[1] = """
+            write("""
 Flags should be used without a '-' prefix
 \td\tUse integer division instead of float division
 \te\tEnable more detailed error messages
+\tj\tCompile straight-line paths into cached Python functions
+\tw\tUse 64-bit integers that wrap around on overflow
+\tp\tProfile the script and show where it spends its steps
 \th\tOutput this help message and exit
 
 \tf\tMake the interpreter timeout after 10 seconds
@@ -525,26 +2494,142 @@ Flags should be used without a '-' prefix
 \tb\tMake the interpreter timeout after 30 seconds
 \tT\tMake the interpreter timeout after 60 seconds
 \tB\tMake the interpreter timeout after 120 seconds
-"""
-            return
 
+Each timeout also comes with a limit on the number of steps executed.
+""")
+            return HALTED
 
-    while True:
-        try:
-            instr = interpreter.move()
-        except StopExecution as stop:
-            out[2] += stop.message
-            return
-        except Exception as e:
-            out[2] += f"{e}"
-            return
 
+    start = time.perf_counter()
+    start_steps = 0
+    try:
+        if snapshot:
+            interpreter.restore(snapshot)
+            start_steps = interpreter._steps
+        # run in slices, flushing in between, so that output shows up while
+        # the script is still running rather than only once the buffer fills
+        status = BUDGET_EXHAUSTED
+        while status == BUDGET_EXHAUSTED and (max_steps is None or interpreter._steps < max_steps):
+            remaining = FLUSH_STEPS if max_steps is None else min(FLUSH_STEPS, max_steps - interpreter._steps)
+            status = interpreter.run(remaining)
+            sink.flush()
+        if status == HALTED and interpreter._message:
+            write_error(interpreter._message)
+            status = ERROR
+        elif status == BUDGET_EXHAUSTED:
+            write_error(f"Code timed out after {max_steps} steps")
+    except Exception as e:
+        write_error(f"{e}")
+        status = ERROR
+    finally:
+        sink.flush()
+        if 'p' in flags:
+            write_error("\n" + interpreter._profile.report())
+        if stats is not None:
+            stats["steps"] = interpreter._steps - start_steps
+            stats["seconds"] = time.perf_counter() - start
+    return status
+
+
+def online_interpreter(code, flags, sink, input=None):
+    """
+    Return an interpreter for a script, set up according to the online
+    interpreter's flags.
+    """
+    flags = flags or ""
+    int64 = 'w' in flags
+    if 'p' in flags:
+        interpreter = ProfilingInterpreter(code, sink, input, int64)
+    elif 'j' in flags:
+        interpreter = TraceInterpreter(code, sink, input, int64)
+    else:
+        interpreter = Interpreter(code, sink, input, int64)
+    if 'd' in flags:
+        interpreter._int_div = True
+    if 'e' in flags:
+        interpreter._debug = True
+    # a stuck script would otherwise hold on to a worker until it times out
+    interpreter._detect_loops = True
+    return interpreter
 
 
-if __name__ == "__main__":
+def execute_batch(code, flags, cases, max_steps=None, processes=None):
+    """
+    Run one script against many inputs, spread over a pool of processes, and
+    yield a result for each case in order as soon as it is available. Each
+    worker parses the script once and resets it between cases.
+    Every result is a dict with the case's stdout and stderr, the number of
+    steps it ran for, how long it took in seconds, and its status: HALTED,
+    ERROR or BUDGET_EXHAUSTED.
+    Arguments:
+        code -- the code to execute as a string
+        flags -- the online interpreter's flags (only d, e, j and w apply)
+        cases -- the input of each case, one line per ':' instruction
+        max_steps -- the number of steps each case may run for (default:
+                     unlimited)
+        processes -- the number of worker processes (default: one per core),
+                     or 1 to run every case in this process
+    """
+    flags = flags.replace("p", "")
+    if processes == 1:
+        _batch_start(code, flags, max_steps)
+        for case in cases:
+            yield _batch_case(case)
+        return
+
+    import multiprocessing
+    with multiprocessing.Pool(processes, _batch_start, (code, flags, max_steps)) as pool:
+        yield from pool.imap(_batch_case, cases)
+
+
+# the interpreter each batch worker runs its cases on
+_batch = None
+
+
+def _batch_start(code, flags, max_steps):
+    global _batch
+    _batch = (online_interpreter(code, flags, None), max_steps)
+
+
+def _batch_case(input_list):
+    """
+    Run one case of a batch on this process's interpreter.
+    """
+    interpreter, max_steps = _batch
+    output = []
+    interpreter.reset()
+    interpreter._sink = OutputSink(output.append, FLUSH_EXIT)
+    interpreter._read = online_input(input_list)
+
+    start = time.perf_counter()
+    try:
+        status = interpreter.run(max_steps)
+        if status == BUDGET_EXHAUSTED:
+            error = f"Code timed out after {max_steps} steps"
+        else:
+            error = interpreter._message or ""
+            if error:
+                status = ERROR
+    except Exception as e:
+        # real error messages are raised in debug mode
+        status = ERROR
+        error = f"{e}"
+    seconds = time.perf_counter() - start
+    interpreter._sink.flush()
+
+    return {"stdout": "".join(output), "stderr": error, "steps": interpreter._steps,
+            "time": seconds, "status": status}
+
+
+
+def main(argv=None):
+    """
+    Run the command line interface.
+    Arguments:
+        argv -- the arguments, not counting the program name (default:
+                sys.argv[1:])
+    """
     import argparse
-    global online
-    online = False
 
     parser = argparse.ArgumentParser(description="""
     Execute a Grok script.
@@ -607,9 +2692,64 @@ if __name__ == "__main__":
                          default=False,
                          dest="show_errors",
                          help="disable \"You don't grok Grok.\" error message and show true error message")
+    options.add_argument("--int64",
+                         action="store_true",
+                         default=False,
+                         help="use 64-bit integers that wrap around on overflow, kept in a typed array, with integer division")
+    options.add_argument("--detect-loops",
+                         action="store_true",
+                         default=False,
+                         dest="detect_loops",
+                         help="stop the script when it gets stuck repeating the same steps without input or output (ignored when ticking or compiling)")
+    options.add_argument("-j", "--jit",
+                         action="store_true",
+                         default=False,
+                         help="compile straight-line paths into cached Python functions (ignored when ticking)")
+    options.add_argument("--compile",
+                         action="store_true",
+                         default=False,
+                         help="translate the script into a cached Python module and run that (ignored when ticking)")
+    options.add_argument("-p", "--profile",
+                         action="store_true",
+                         default=False,
+                         help="count how often each cell and instruction is executed, and print a report at the end (ignored when ticking)")
+    options.add_argument("--profile-output",
+                         metavar="<file>",
+                         help="also save the profile to a file, as CSV if it ends in .csv and as JSON otherwise")
+    options.add_argument("--record",
+                         metavar="<file>",
+                         help="record every step of the run to a file, which grok_replay.py can show the state after any step of (ignored when ticking or profiling)")
+    options.add_argument("--batch",
+                         type=argparse.FileType("r"),
+                         metavar="<file>",
+                         help="run the script once for each case in a JSON lines file, where a case is a string of input or an object with an \"input\" key, and print each result as a line of JSON")
+    options.add_argument("--max-steps",
+                         type=int,
+                         metavar="<steps>",
+                         help="stop each batch case after this many steps")
+    options.add_argument("--workers",
+                         type=int,
+                         metavar="<count>",
+                         help="the number of processes running batch cases (default: one per core)")
+    options.add_argument("--checkpoint",
+                         metavar="<file>",
+                         help="save a snapshot of the script's state to a file every so often, which --resume can continue from (ignored when ticking or compiling)")
+    options.add_argument("--checkpoint-every",
+                         type=int,
+                         default=CHECKPOINT_STEPS,
+                         metavar="<steps>",
+                         help="the number of steps between checkpoints (default: %(default)s)")
+    options.add_argument("--resume",
+                         type=argparse.FileType("rb"),
+                         metavar="<file>",
+                         help="continue the script from a snapshot saved by --checkpoint")
+    options.add_argument("-f", "--flush",
+                         choices=FLUSH_POLICIES,
+                         metavar="<policy>",
+                         help="when to flush buffered output: unbuffered, line, size or exit (default: unbuffered when ticking, line on a terminal, size otherwise)")
 
     # parse arguments from sys.argv
-    arguments = parser.parse_args()
+    arguments = parser.parse_args(argv)
 
     # initialize an interpreter
     if arguments.script:
@@ -618,34 +2758,151 @@ if __name__ == "__main__":
     else:
         code = arguments.code
 
-    interpreter = Interpreter(code)
+    if arguments.batch:
+        import json
+        cases = [json.loads(line) for line in arguments.batch if line.strip()]
+        arguments.batch.close()
+        cases = [case if isinstance(case, dict) else {"input": case} for case in cases]
+        flags = ("d" if arguments.int_div else "") + ("e" if arguments.show_errors else "") + ("j" if arguments.jit else "") + ("w" if arguments.int64 else "")
+        try:
+            results = execute_batch(code, flags, [case.get("input", "") for case in cases],
+                                    arguments.max_steps, arguments.workers)
+            for number, (case, result) in enumerate(zip(cases, results)):
+                # pass everything but the input back, so cases can be told apart
+                record = {key: value for key, value in case.items() if key != "input"}
+                record.update(result, case=number)
+                sys.stdout.write(json.dumps(record) + "\n")
+                sys.stdout.flush()
+        except KeyboardInterrupt:
+            parser.exit(message="\n")
+        parser.exit()
+
+    if arguments.flush:
+        policy = arguments.flush
+    elif arguments.tick:
+        policy = FLUSH_UNBUFFERED
+    elif sys.stdout.isatty():
+        policy = FLUSH_LINE
+    else:
+        policy = FLUSH_SIZE
+    sink = OutputSink(write_stdout, policy)
+
+    # the compiled engines can't tick between instructions
+    compiled = None
+    recorder = None
+    if arguments.profile and not arguments.tick:
+        # profiling needs to see every step
+        interpreter = ProfilingInterpreter(code, sink, int64=arguments.int64)
+    elif arguments.record and not arguments.tick:
+        # so does recording
+        recorder = Recorder(open(arguments.record, "wb"), code)
+        interpreter = RecordingInterpreter(code, recorder, sink, int64=arguments.int64)
+    elif arguments.compile and not arguments.tick and not (arguments.checkpoint or arguments.resume):
+        compiled = load_compiled(code, arguments.int_div)
+        # the compiled module only needs the interpreter's state and handlers
+        interpreter = Interpreter("", sink, int64=arguments.int64)
+    elif arguments.jit and not arguments.tick:
+        interpreter = TraceInterpreter(code, sink, int64=arguments.int64)
+    else:
+        interpreter = Interpreter(code, sink, int64=arguments.int64)
 
     if arguments.show_errors:
         interpreter._debug = True
     if arguments.int_div:
         interpreter._int_div = True
+    if arguments.detect_loops:
+        interpreter._detect_loops = True
 
 
     # add supplied values to the interpreters stack
     if arguments.stack:
         for x in arguments.stack:
             if isinstance(x, str):
-                interpreter._stack += [float(ord(c)) for c in x]
+                for c in x:
+                    interpreter._push(ord(c))
             else:
-                interpreter._stack += x
+                for value in x:
+                    # whole numbers are pushed as ints, to keep the stack in
+                    # int mode
+                    if value.is_integer():
+                        value = int(value)
+                    else:
+                        interpreter._floats = True
+                    interpreter._push(value)
+
+    if arguments.resume:
+        try:
+            interpreter.restore(arguments.resume.read())
+        except ValueError as e:
+            parser.error(f"can't resume from {arguments.resume.name}: {e}")
+        arguments.resume.close()
+
+    def save_checkpoint():
+        # replace the previous checkpoint in one go, so there always is one
+        temp = arguments.checkpoint + ".tmp"
+        with open(temp, "wb") as f:
+            f.write(interpreter.snapshot())
+        os.replace(temp, arguments.checkpoint)
+
+    def report_profile():
+        if not isinstance(interpreter, ProfilingInterpreter):
+            return
+        profile = interpreter._profile
+        sys.stderr.write("\n" + profile.report() + "\n")
+        if arguments.profile_output:
+            with open(arguments.profile_output, "w", encoding="utf-8") as f:
+                f.write(profile.to_csv() if arguments.profile_output.endswith(".csv") else profile.to_json())
 
     # run the script
     try:
-        while True:
-            try:
-                instr = interpreter.move()
-            except StopExecution as stop:
-                # only print a newline if the script didn't and it hasn't been disabled
-                newline = ("\n" if (not interpreter._newline) and interpreter._newline != None and (not arguments.no_newline) else "")
-                parser.exit(message=(newline+stop.message+"\n") if stop.message else newline)
-
-            if instr and not instr == " " or arguments.always_tick:
-                time.sleep(arguments.tick)
+        try:
+            if compiled:
+                try:
+                    compiled.run(interpreter)
+                except StopExecution:
+                    raise
+                except KeyboardInterrupt:
+                    # avoid catching as error
+                    raise KeyboardInterrupt
+                except Exception as e:
+                    if interpreter._debug:
+                        raise
+                    raise StopExecution("You don't grok Grok.")
+            elif arguments.tick:
+                while True:
+                    instr = interpreter.move()
+                    if instr and not instr == " " or arguments.always_tick:
+                        time.sleep(arguments.tick)
+            elif arguments.checkpoint:
+                while interpreter.run(arguments.checkpoint_every) != HALTED:
+                    sink.flush()
+                    save_checkpoint()
+                # the script is done, there is nothing left to resume
+                try:
+                    os.remove(arguments.checkpoint)
+                except OSError:
+                    pass
+                raise StopExecution(interpreter._message)
+            else:
+                interpreter.run()
+                raise StopExecution(interpreter._message)
+        except StopExecution as stop:
+            sink.flush()
+            report_profile()
+            # only print a newline if the script didn't and it hasn't been disabled
+            newline = ("\n" if (not interpreter._newline) and interpreter._newline != None and (not arguments.no_newline) else "")
+            parser.exit(message=(newline+stop.message+"\n") if stop.message else newline)
     except KeyboardInterrupt:
         # exit cleanly
+        sink.flush()
+        report_profile()
         parser.exit(message="\n")
+    finally:
+        # show the output that led up to an error
+        sink.flush()
+        if recorder:
+            recorder.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+"""
+Admission control for the online interpreter. Only so many runs go at once;
+the rest wait in a bounded queue, and each client may only have a few runs
+queued or going. Runs are admitted earliest deadline first, counting from
+when they arrived with the timeout of their tier, so short runs overtake
+long ones without long ones waiting forever.
+"""
+
+import asyncio
+import heapq
+import itertools
+import math
+import threading
+import time
+
+# states of a ticket
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+
+
+class QueueFull(Exception):
+    """
+    Raised when a run can't be queued, because the client has too many runs
+    (reason "client") or the queue is full (reason "queue"), with a guess at
+    how many seconds it will be until there is room for it in retry_after.
+    """
+    def __init__(self, message, reason, retry_after):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """
+    A run's place in the queue, and then its slot once it is admitted.
+    """
+    def __init__(self, admission, client, priority, depth):
+        self.client = client
+        # the runs that were queued when it arrived
+        self.depth = depth
+        # how long it waited to be admitted, once it is
+        self.wait = None
+        self.state = QUEUED
+        self._admission = admission
+        self._priority = priority
+        self._queued = time.monotonic()
+        self._admitted = None
+        # resolved with whether the run was admitted, for admitted()
+        self._future = None
+
+    async def admitted(self):
+        """
+        Wait for the run to be admitted, and return True, or False if it was
+        cancelled first.
+        """
+        with self._admission._lock:
+            if self.state != QUEUED:
+                return self.state == RUNNING
+            self._future = asyncio.get_running_loop().create_future()
+        return await self._future
+
+    def position(self):
+        """
+        Return how many queued runs are ahead of this one, or None if it
+        isn't queued.
+        """
+        return self._admission._position(self)
+
+    def cancel(self):
+        """
+        Leave the queue, if the run is still waiting to be admitted.
+        """
+        self._admission._leave(self, QUEUED)
+
+    def release(self):
+        """
+        Give up the ticket once the run is over, admitting the next one.
+        """
+        self._admission._leave(self, None)
+
+
+class Admission:
+    """
+    Bounded queue of runs in front of a limited number of slots.
+    """
+    def __init__(self, max_running, max_queued, max_per_client):
+        """
+        Arguments:
+            max_running -- the most runs going at once
+            max_queued -- the most runs waiting to be admitted
+            max_per_client -- the most runs a client may have queued and
+                              going together
+        """
+        self._max_running = max_running
+        self._max_queued = max_queued
+        self._max_per_client = max_per_client
+        self._running = 0
+        # (priority, arrival, ticket), including tickets that were cancelled
+        # while queued, which are skipped
+        self._queue = []
+        self._queued = 0
+        self._arrivals = itertools.count()
+        # client -> runs it has queued and going
+        self._clients = {}
+        # average time a run holds its slot, for guessing retry times
+        self._hold = 1.0
+        self._lock = threading.Lock()
+
+    def reserve(self, client, timeout):
+        """
+        Queue a run, admitting it straight away if there is a free slot, and
+        return its ticket. Raises QueueFull if the queue is full or the client
+        has too many runs already.
+        Arguments:
+            client -- who the run is for, like their address
+            timeout -- the run's timeout in seconds, which sets its priority
+        """
+        with self._lock:
+            if self._clients.get(client, 0) >= self._max_per_client:
+                raise QueueFull("You have too many runs going.", "client", self._retry_after(0))
+            if self._queued >= self._max_queued:
+                raise QueueFull("Too many runs are queued.", "queue", self._retry_after(self._queued))
+            ticket = Ticket(self, client, time.monotonic() + timeout, self._queued)
+            self._clients[client] = self._clients.get(client, 0) + 1
+            heapq.heappush(self._queue, (ticket._priority, next(self._arrivals), ticket))
+            self._queued += 1
+            self._admit()
+        return ticket
+
+    def queued(self):
+        """
+        Return the number of runs waiting to be admitted.
+        """
+        with self._lock:
+            return self._queued
+
+    def running(self):
+        """
+        Return the number of runs admitted and not yet released.
+        """
+        with self._lock:
+            return self._running
+
+    def _admit(self):
+        """
+        Admit queued runs while there are free slots.
+        """
+        while self._running < self._max_running and self._queue:
+            _, _, ticket = heapq.heappop(self._queue)
+            if ticket.state != QUEUED:
+                continue
+            self._queued -= 1
+            self._running += 1
+            ticket.state = RUNNING
+            ticket._admitted = time.monotonic()
+            ticket.wait = ticket._admitted - ticket._queued
+            _resolve(ticket._future, True)
+
+    def _leave(self, ticket, state):
+        """
+        Drop a ticket if it is in the given state, or any state but DONE if
+        state is None.
+        """
+        with self._lock:
+            if ticket.state == DONE or state not in (None, ticket.state):
+                return
+            if ticket.state == QUEUED:
+                # left in the heap, to be skipped
+                self._queued -= 1
+                _resolve(ticket._future, False)
+            else:
+                self._running -= 1
+                self._hold = 0.9 * self._hold + 0.1 * (time.monotonic() - ticket._admitted)
+            ticket.state = DONE
+            self._clients[ticket.client] -= 1
+            if not self._clients[ticket.client]:
+                del self._clients[ticket.client]
+            self._admit()
+
+    def _position(self, ticket):
+        with self._lock:
+            if ticket.state != QUEUED:
+                return None
+            return sum(1 for priority, _, other in self._queue
+                       if other.state == QUEUED and (priority, other._queued) < (ticket._priority, ticket._queued))
+
+    def _retry_after(self, ahead):
+        """
+        Guess how many seconds it takes for ahead runs, and one more, to get
+        through the slots.
+        """
+        return max(1, math.ceil(self._hold * (ahead + 1) / self._max_running))
+
+
+def _resolve(future, value):
+    # futures belong to the event loop awaiting them, which may be running
+    # in another thread
+    if future is not None:
+        future.get_loop().call_soon_threadsafe(lambda: future.done() or future.set_result(value))
@@ -0,0 +1,4 @@
+"""
+Benchmarks for the PyGrok interpreter. Run them with:
+    python -m benchmarks [-o results.json] [--compare baseline.json]
+"""
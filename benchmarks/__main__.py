@@ -0,0 +1,295 @@
+"""
+Run the benchmarks and report steps per second, wall time, peak memory and
+startup time, for each engine run in-process, for PyGrok.execute, and for
+the command line interpreter, along with the startup time through
+grok_daemon.py.
+    python -m benchmarks [-o results.json] [--compare baseline.json]
+Results are written as JSON keyed by workload and engine, so that runs from
+different commits can be compared with --compare.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.workloads import workloads
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import PyGrok
+
+# how much slower a result can get before --compare reports it
+DEFAULT_THRESHOLD = 0.1
+# how long the daemon may take to start listening, in seconds
+DAEMON_START_SECONDS = 10
+
+
+def discard(chunk):
+    pass
+
+
+def run_engine(engine, code, inputs, cache_dir):
+    """
+    Run a script to completion on one engine, and return the interpreter.
+    """
+    sink = PyGrok.OutputSink(discard, PyGrok.FLUSH_SIZE)
+    read = PyGrok.online_input(inputs)
+
+    if engine == "compiled":
+        compiled = PyGrok.load_compiled(code, cache_dir=cache_dir)
+        interpreter = PyGrok.Interpreter("", sink, read)
+        try:
+            compiled.run(interpreter)
+        except PyGrok.StopExecution as stop:
+            interpreter._message = stop.message
+    elif engine == "int64":
+        interpreter = PyGrok.Interpreter(code, sink, read, int64=True)
+        interpreter.run()
+    elif engine == "record":
+        os.makedirs(cache_dir, exist_ok=True)
+        recorder = PyGrok.Recorder(open(os.path.join(cache_dir, "recording"), "wb"), code)
+        interpreter = PyGrok.RecordingInterpreter(code, recorder, sink, read)
+        try:
+            interpreter.run()
+        finally:
+            recorder.close()
+    else:
+        if engine == "jit":
+            interpreter = PyGrok.TraceInterpreter(code, sink, read)
+        else:
+            interpreter = PyGrok.Interpreter(code, sink, read)
+        interpreter.run()
+    sink.flush()
+    return interpreter
+
+
+def bench_engine(engine, code, inputs, repeat, cache_dir):
+    """
+    Return the best wall time of a script on one engine, its step count and
+    the peak memory traced while running it once more.
+    """
+    if engine == "compiled":
+        # translate outside the timed runs, as a cached script would be
+        PyGrok.load_compiled(code, cache_dir=cache_dir)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        interpreter = run_engine(engine, code, inputs, cache_dir)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+
+    tracemalloc.start()
+    run_engine(engine, code, inputs, cache_dir)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {"seconds": best, "steps": interpreter._steps, "peak_memory": peak,
+            "message": interpreter._message}
+
+
+def bench_execute(code, inputs, repeat):
+    """
+    Return the best wall time of a script run through PyGrok.execute.
+    """
+    best = None
+    for _ in range(repeat):
+        output = {1: "", 2: ""}
+        start = time.perf_counter()
+        PyGrok.execute(code, "", inputs, output)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return {"seconds": best}
+
+
+def bench_cli(path, inputs, repeat, program="PyGrok.py", env=None):
+    """
+    Return the best wall time and the peak resident memory of a script run
+    by the command line interpreter in a new process.
+    """
+    best = None
+    peak = 0
+    with tempfile.TemporaryFile() as stdin:
+        stdin.write(inputs.encode("utf-8"))
+        for _ in range(repeat):
+            stdin.seek(0)
+            start = time.perf_counter()
+            process = subprocess.Popen([sys.executable, os.path.join(ROOT, program), path], env=env,
+                                       stdin=stdin, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            # wait4 reports the resources used by this process alone
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            seconds = time.perf_counter() - start
+            best = seconds if best is None else min(best, seconds)
+            # ru_maxrss is in kilobytes on Linux, and in bytes on macOS
+            peak = max(peak, usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024))
+    return {"seconds": best, "peak_rss": peak}
+
+
+def bench_daemon(path, repeat, directory):
+    """
+    Return the best wall time of a script run through grok_daemon.py, with a
+    daemon running.
+    """
+    env = dict(os.environ, GROK_SOCKET=os.path.join(directory, "pygrok.sock"))
+    # a file rather than a pipe, which the daemon could fill up and block on
+    with tempfile.TemporaryFile() as stderr:
+        daemon = subprocess.Popen([sys.executable, os.path.join(ROOT, "grok_daemon.py"), "--serve"], env=env,
+                                  stderr=stderr)
+        try:
+            # wait for the daemon to listen
+            deadline = time.monotonic() + DAEMON_START_SECONDS
+            while not os.path.exists(env["GROK_SOCKET"]):
+                if daemon.poll() is not None or time.monotonic() > deadline:
+                    stderr.seek(0)
+                    raise RuntimeError("The daemon didn't start: {}".format(
+                        stderr.read().decode("utf-8", "replace").strip() or "no error output"))
+                time.sleep(0.01)
+            return bench_cli(path, "", repeat, "grok_daemon.py", env)["seconds"]
+        finally:
+            daemon.terminate()
+            daemon.wait()
+
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    """
+    Run the selected benchmarks, printing each result as it comes in, and
+    return all results.
+    """
+    results = {
+        "commit": commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scale": args.scale,
+        "repeat": args.repeat,
+        "workloads": {},
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache_dir = os.path.join(directory, "cache")
+
+        # startup: the time it takes to run a script that quits at once
+        path = os.path.join(directory, "quit.grok")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("q")
+        results["startup"] = {"execute": bench_execute("q", "", args.repeat)["seconds"],
+                              "cli": bench_cli(path, "", args.repeat)["seconds"],
+                              "daemon": bench_daemon(path, args.repeat, directory)}
+        print("startup: execute {execute:.6f}s, cli {cli:.6f}s, daemon {daemon:.6f}s".format(**results["startup"]),
+              file=sys.stderr)
+
+        for name, (code, inputs) in workloads(args.scale).items():
+            if args.only and not any(pattern in name for pattern in args.only):
+                continue
+            result = {}
+            for engine in args.engines:
+                measured = bench_engine(engine, code, inputs, args.repeat, cache_dir)
+                if engine == "compiled":
+                    # compiled scripts don't count their steps
+                    measured["steps"] = result["interpreter"]["steps"] if "interpreter" in result else None
+                if measured["steps"]:
+                    measured["steps_per_second"] = measured["steps"] / measured["seconds"]
+                result[engine] = measured
+                print("{}: {}: {:.6f}s, {} steps, {:.0f} steps/s, {} bytes peak".format(
+                    name, engine, measured["seconds"], measured["steps"],
+                    measured.get("steps_per_second", 0), measured["peak_memory"]), file=sys.stderr)
+
+            if not args.no_execute:
+                result["execute"] = bench_execute(code, inputs, args.repeat)
+                print("{}: execute: {:.6f}s".format(name, result["execute"]["seconds"]), file=sys.stderr)
+            if not args.no_cli:
+                path = os.path.join(directory, name + ".grok")
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write(code)
+                result["cli"] = bench_cli(path, inputs, args.repeat)
+                print("{}: cli: {:.6f}s, {} bytes peak".format(
+                    name, result["cli"]["seconds"], result["cli"]["peak_rss"]), file=sys.stderr)
+            results["workloads"][name] = result
+
+    return results
+
+
+def compare(old, new, threshold):
+    """
+    Print how each result changed from an earlier run, and return whether
+    any of them got slower by more than threshold.
+    """
+    regressed = False
+    if old.get("scale") != new.get("scale"):
+        print("warning: comparing runs with different scales", file=sys.stderr)
+
+    def report(label, before, after):
+        nonlocal regressed
+        change = after / before - 1
+        flag = ""
+        if change > threshold:
+            flag = "  SLOWER"
+            regressed = True
+        elif change < -threshold:
+            flag = "  faster"
+        print("{:40} {:12.6f}s -> {:12.6f}s {:+7.1%}{}".format(label, before, after, change, flag))
+
+    for key in ("execute", "cli", "daemon"):
+        if key in old.get("startup", {}) and key in new.get("startup", {}):
+            report("startup: " + key, old["startup"][key], new["startup"][key])
+    for name, result in new["workloads"].items():
+        for engine, measured in result.items():
+            try:
+                before = old["workloads"][name][engine]["seconds"]
+            except KeyError:
+                continue
+            report("{}: {}".format(name, engine), before, measured["seconds"])
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Benchmark the Grok interpreter.")
+    parser.add_argument("-o", "--output", help="write the results to this file as JSON")
+    parser.add_argument("-c", "--compare", help="compare with the results in this file")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="report results that got slower by more than this fraction (default: %(default)s)")
+    parser.add_argument("-s", "--scale", type=float, default=1, help="multiply the size of the generated workloads")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="keep the best of this many runs")
+    parser.add_argument("-e", "--engines", default="interpreter,jit,compiled,int64",
+                        help="comma separated engines to run in-process: interpreter, jit, compiled, int64 or "
+                             "record (default: %(default)s)")
+    parser.add_argument("--only", action="append", help="only run workloads whose name contains this")
+    parser.add_argument("--no-execute", action="store_true", help="skip PyGrok.execute")
+    parser.add_argument("--no-cli", action="store_true", help="skip the command line interpreter")
+    args = parser.parse_args()
+    args.engines = args.engines.split(",")
+    for engine in args.engines:
+        if engine not in ("interpreter", "jit", "compiled", "int64", "record"):
+            parser.error("unknown engine: " + engine)
+
+    results = run(args)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            old = json.load(f)
+        if compare(old, results, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+The programs benchmarked: the example programs, plus generated workloads that
+each stress one part of the interpreter.
+"""
+
+import os
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Example Programs")
+
+
+def loop(init, body, width=0, height=0):
+    """
+    Return a program that runs init once, then repeats body until the value
+    it leaves on top of the stack is 0. body has to end in '{', which leaves
+    the loop. width and height pad the loop with that many blank columns and
+    empty rows, to make the wordbox sparse without changing what it does.
+    """
+    col = len(init)
+    rows = [init + "j" + " " * (len(body) - 1) + "q",
+            " " * col + "l" + body + " " * width + "j"]
+    rows += [""] * height
+    rows.append(" " * col + "k" + " " * (len(body) + width) + "h")
+    return "\n".join(rows)
+
+
+def example(name, inputs=""):
+    with open(os.path.join(EXAMPLES, name), encoding="utf-8") as f:
+        return f.read(), inputs
+
+
+def countdown(n, width=0, height=0):
+    # tight arithmetic loop
+    return loop("i{}`".format(n), "1-YP{", width, height), ""
+
+
+def deep_stack(n):
+    # leaves n values on the stack
+    return loop("i{}`".format(n), "YP1-YP{"), ""
+
+
+def big_integers(digits):
+    # triples a number until it has more than the given number of digits.
+    # Python refuses to parse integers of more than 4300 digits, which is
+    # as long as an insert mode number can get
+    return loop("i1{}`1".format("0" * digits), "3*YP2yP>!{"), ""
+
+
+def output(n):
+    # writes n characters
+    return loop("i{}`".format(n), "i65`w1-YP{"), ""
+
+
+def input_lines(n):
+    # reads n lines
+    return loop("i{}`".format(n), ":x1-YP{"), "\n".join(["12"] * n)
+
+
+def workloads(scale=1):
+    """
+    Return a dict of workload names to (code, inputs). The names and sizes
+    are fixed for a given scale, so results stay comparable across commits.
+    """
+    return {
+        "example-helloworld": example("helloworld.grok"),
+        "example-truthmachine": example("truthmachine.grok", "0"),
+        "example-cat": example("cat.grok", "hello"),
+        "countdown": countdown(int(100000 * scale)),
+        "sparse-wide": countdown(int(2000 * scale), width=500),
+        "sparse-tall": countdown(int(2000 * scale), height=500),
+        "deep-stack": deep_stack(int(100000 * scale)),
+        "big-integers": big_integers(4000),
+        "output": output(int(100000 * scale)),
+        "input": input_lines(int(20000 * scale)),
+    }
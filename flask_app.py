@@ -1,84 +1,573 @@
-from flask import Flask, render_template, request
+from flask import Flask, Response, render_template, request
 from flask_cors import CORS
-import multiprocessing, secrets
-import PyGrok
+import asyncio, json, threading
+from time import monotonic
 import git
+from worker_pool import WorkerPool, STDOUT, STDERR, DONE, STATS, TIMED_OUT, CANCELLED
+from result_cache import ResultCache, cache_key
+from scheduler import Scheduler, Job, EVICTED
+from sessions import SessionRegistry
+from jobs import RunExecutor
+from admission import Admission, QueueFull
+from metrics import Registry, Counter, Gauge, Histogram
+import PyGrok
 app = Flask(__name__)
 CORS(app)
 
-import os, sys, shutil
+import os, sys
 
 THIS_FOLDER = os.path.dirname(os.path.abspath(__file__)) + "/.."
 sys.path.insert(1, THIS_FOLDER)
 
-shutil.rmtree("sessions", ignore_errors=True)
-os.system("mkdir sessions")
+# one session per open page, which runs one script at a time
+SESSION_TTL = 24 * 60 * 60
+MAX_SESSIONS = 10000
+sessions = SessionRegistry(SESSION_TTL, MAX_SESSIONS)
+CANCELLED_MESSAGE = "Stopped by a newer run in the same session"
+STOPPED_MESSAGE = "Stopped on request"
+
+# warm worker processes that run the submitted scripts
+WORKERS = 4
+JOBS_PER_WORKER = 100
+# instructions a script may execute per second of its timeout
+STEPS_PER_SECOND = 1000000
+pool = WorkerPool(WORKERS, JOBS_PER_WORKER)
+
+# scripts share a scheduler in this process, and are only moved to a worker
+# once they have run for long or their steps have become slow. Integers up
+# to IN_PROCESS_BITS bits keep a slice's steps to microseconds each
+SLICE_STEPS = 10000
+IN_PROCESS_STEPS = 1000000
+SLICE_SECONDS = 0.1
+IN_PROCESS_BITS = 2048
+scheduler = Scheduler(SLICE_STEPS, IN_PROCESS_STEPS, SLICE_SECONDS, IN_PROCESS_BITS)
+threading.Thread(target=scheduler.serve, daemon=True).start()
+
+# results of runs that halted, so that repeated runs skip the workers
+CACHE_ENTRIES = 1000
+CACHE_BYTES = 64 * 1024 * 1024
+# set to keep cached results across restarts
+CACHE_DIR = os.environ.get("GROK_CACHE_DIR")
+cache = ResultCache(CACHE_ENTRIES, CACHE_BYTES, CACHE_DIR)
 
-sessions = {}
-terminated = set()
+# runs are driven in the background, so requests only wait on them if they
+# want to; a thread per worker reads the workers' output
+MAX_RUNS = 10000
+RUN_TTL = 5 * 60
+# the longest a request waiting on a run is held, in seconds
+MAX_WAIT = 30
+# chunks of output a run may have waiting to be passed on to its readers;
+# past it, the script is held up until they catch up
+QUEUED_CHUNKS = 16
+# output kept for each run's readers, in characters; past it, the oldest is
+# dropped
+MAX_OUTPUT = 1024 * 1024
+executor = RunExecutor(WORKERS, MAX_RUNS, RUN_TTL, MAX_OUTPUT)
+
+# runs going at once, on the scheduler and the workers together, and runs
+# waiting for their turn; past either limit, requests are turned away
+MAX_RUNNING = 16
+MAX_QUEUED = 256
+# runs each client (by address) may have queued and going
+MAX_PER_CLIENT = 4
+admission = Admission(MAX_RUNNING, MAX_QUEUED, MAX_PER_CLIENT)
+
+# exported at /metrics
+metrics = Registry()
+REQUESTS = metrics.add(Counter("grok_requests_total", "Requests handled, by endpoint", ["endpoint"]))
+REQUEST_SECONDS = metrics.add(Histogram("grok_request_seconds",
+                                        "Time taken to answer a request, up to the end of a streamed response",
+                                        ["endpoint"]))
+RUNS = metrics.add(Counter("grok_runs_total", "Scripts run, by timeout tier and how they finished",
+                           ["tier", "status"]))
+QUEUE_SECONDS = metrics.add(Histogram("grok_queue_wait_seconds",
+                                      "Time scripts waited for the scheduler or a worker to start them", ["queue"]))
+RUN_SECONDS = metrics.add(Histogram("grok_run_seconds", "Time spent executing scripts, not counting waits",
+                                    ["tier"]))
+STEPS = metrics.add(Counter("grok_steps_total", "Instructions executed, by timeout tier", ["tier"]))
+STEP_RATE = metrics.add(Histogram("grok_run_steps_per_second", "Instructions executed per second of each run",
+                                  buckets=(1e4, 3e4, 1e5, 3e5, 1e6, 3e6, 1e7)))
+OUTPUT_BYTES = metrics.add(Counter("grok_output_bytes_total", "Output written by scripts", ["stream"]))
+TIMEOUTS = metrics.add(Counter("grok_timeouts_total", "Scripts stopped by their time or step limit, by tier",
+                               ["tier", "limit"]))
+ERRORS = metrics.add(Counter("grok_errors_total",
+                             "Scripts that stopped with an error: grok for the generic message, exception for "
+                             "a real error message (the e flag) and infinite_loop for a detected loop", ["kind"]))
+metrics.add(Gauge("grok_workers", "Worker processes in the pool", function=lambda: pool.size))
+metrics.add(Gauge("grok_workers_busy", "Worker processes running a script", function=pool.busy))
+metrics.add(Gauge("grok_sessions", "Live sessions", function=lambda: len(sessions)))
+metrics.add(Gauge("grok_runs", "Runs going or kept for their readers", function=lambda: len(executor)))
+metrics.add(Gauge("grok_admission_queued", "Runs waiting to be admitted", function=admission.queued))
+metrics.add(Gauge("grok_admission_running", "Runs admitted and not yet over", function=admission.running))
+REJECTED = metrics.add(Counter("grok_rejected_total", "Runs turned away because the server was busy", ["reason"]))
 
 @app.route('/', methods=['POST','GET'])
 def index():
-    session = secrets.token_hex(64)
-    sessions[session] = None
-    return render_template('main.html', session=session)
+    return render_template('main.html', session=sessions.create())
 
 
-@app.route("/execute", methods=['POST'])
-def execute():
+# flags raising the timeout, in the order they take precedence, and the
+# timeout without any of them
+TIERS = (("f", 10), ("F", 15), ("b", 30), ("T", 60), ("B", 120))
+DEFAULT_TIMEOUT = 5
+
+
+def tier(flags):
+    """
+    Return the flag that sets a run's timeout, or "default" if none does.
+    """
+    for flag, _ in TIERS:
+        if flag in flags:
+            return flag
+    return "default"
+
+
+def limits(flags):
+    """
+    Return the wall-clock limit in seconds and the step budget for a run.
+    The step budget makes results independent of the host's load, while the
+    wall-clock limit still catches slow instructions.
+    """
+    time = dict(TIERS).get(tier(flags), DEFAULT_TIMEOUT)
+    return time, time * STEPS_PER_SECOND
+
+
+def submit_run(code, flags, input_list, session, client):
+    """
+    Start running a script in the background, or answer it from the cache,
+    and return its jobs.Run straight away. Raises QueueFull if there is no
+    room for the run.
+    """
+    time, steps = limits(flags)
+    key = cache_key(code, flags, input_list)
+    cached = cache.get(key) if cacheable(flags) else None
+    # cached results are cheap enough to skip the queue
+    ticket = None if cached else admission.reserve(client, time)
+    # a run that got a place replaces whatever the session was running, even
+    # if its result turns out to be cached; one turned away leaves it be
+    sessions.start(session, None)
+
+    async def main(run):
+        if cached:
+            stdout, stderr = cached
+            if stdout:
+                run.emit(STDOUT, stdout)
+            if stderr:
+                run.emit(STDERR, stderr)
+            run.emit(DONE, PyGrok.HALTED)
+            return
+
+        status = await run_script(run, ticket, code, flags, input_list, time, steps, session)
+        # output that was partly dropped can't be cached
+        if status == PyGrok.HALTED and cacheable(flags) and not run.dropped:
+            stdout, stderr = output(run.events)
+            cache.put(key, stdout, stderr)
+        elif status == TIMED_OUT:
+            run.emit(STDERR, "\n" + f"Code timed out after {time} seconds")
+        elif status == CANCELLED:
+            run.emit(STDERR, "\n" + (STOPPED_MESSAGE if run.cancelled else CANCELLED_MESSAGE))
+        run.emit(DONE, status)
+
+    run = executor.submit(main)
+    run.admission = ticket
+    return run
+
+
+def output(events):
+    """
+    Return the stdout and stderr of a run's events, each joined together.
+    """
+    output = {STDOUT: [], STDERR: []}
+    for kind, data in events:
+        output[kind].append(data)
+    return "".join(output[STDOUT]), "".join(output[STDERR])
+
+
+async def run_script(run, ticket, code, flags, input_list, time, steps, session):
+    """
+    Run a script for up to time seconds and steps steps once its admission
+    ticket comes up, passing its output on to run.emit() as (STDOUT, chunk)
+    and (STDERR, message), recording its metrics, and return its status like
+    WorkerPool.stream(). Starting a run cancels the session's previous one,
+    which then finishes with the status CANCELLED.
+    """
+    stats = {}
+    status = None
+    error = None
+    try:
+        async for kind, data in _run_script(run, ticket, code, flags, input_list, time, steps, session, stats):
+            if kind == STATS:
+                for key, value in data.items():
+                    stats[key] = stats.get(key, 0) + value
+            elif kind == DONE:
+                status = data
+            else:
+                OUTPUT_BYTES.inc(len(data.encode("utf-8", "surrogatepass")),
+                                 stream="stdout" if kind == STDOUT else "stderr")
+                # profiles are written after the error message
+                if kind == STDERR and error is None:
+                    error = data
+                run.emit(kind, data)
+    finally:
+        ticket.release()
+        if ticket.wait is not None:
+            stats["admission_wait"] = ticket.wait
+        record_run(tier(flags), status, error, stats)
+    return status
+
+
+def record_run(tier, status, error, stats):
+    """
+    Record the metrics of a finished run.
+    Arguments:
+        tier -- the run's timeout tier (see tier())
+        status -- how it finished, or None if the reader went away first
+        error -- the first message it wrote to stderr, if any
+        stats -- its counters: steps run and seconds taken, and the time it
+                 waited to be admitted under "admission_wait", then to start
+                 under "scheduler_wait" or "queue_wait"
+    """
+    RUNS.inc(tier=tier, status=status or "abandoned")
+    steps = stats.get("steps", 0)
+    seconds = stats.get("seconds", 0)
+    STEPS.inc(steps, tier=tier)
+    if seconds:
+        RUN_SECONDS.observe(seconds, tier=tier)
+        STEP_RATE.observe(steps / seconds)
+    if "admission_wait" in stats:
+        QUEUE_SECONDS.observe(stats["admission_wait"], queue="admission")
+    if "scheduler_wait" in stats:
+        QUEUE_SECONDS.observe(stats["scheduler_wait"], queue="scheduler")
+    if "queue_wait" in stats:
+        QUEUE_SECONDS.observe(stats["queue_wait"], queue="pool")
+    if status == TIMED_OUT:
+        TIMEOUTS.inc(tier=tier, limit="time")
+    elif status == PyGrok.BUDGET_EXHAUSTED:
+        TIMEOUTS.inc(tier=tier, limit="steps")
+    elif status == PyGrok.ERROR:
+        if error == "You don't grok Grok.":
+            kind = "grok"
+        elif error and error.startswith("infinite loop detected"):
+            kind = "infinite_loop"
+        else:
+            kind = "exception"
+        ERRORS.inc(kind=kind)
+
+
+async def _run_script(run, ticket, code, flags, input_list, time, steps, session, stats):
+    """
+    Run a script like run_script(), yielding its output along with the
+    (STATS, stats) of runs on a worker, and adding the steps and time it
+    takes on the scheduler to stats.
+    """
+    cancelled = threading.Event()
+    job = None
+
+    def cancel():
+        cancelled.set()
+        ticket.cancel()
+        if job is not None:
+            scheduler.cancel(job)
+
+    run.on_cancel = cancel
+    if run.cancelled:
+        # cancelled before there was anything to stop
+        cancel()
+        yield DONE, CANCELLED
+        return
+    if not sessions.start(session, cancel):
+        yield DONE, CANCELLED
+        return
+    try:
+        if not await ticket.admitted():
+            yield DONE, CANCELLED
+            return
+
+        # profiles and help are written by PyGrok.stream_execute(), so those
+        # runs go straight to a worker
+        if "p" in flags or "h" in flags:
+            async for item in stream_from_pool(code, flags, input_list, time, steps, None, cancelled):
+                yield item
+            return
+
+        deadline = monotonic() + time
+        loop = asyncio.get_running_loop()
+        output = asyncio.Queue(QUEUED_CHUNKS)
+        put = lambda item: asyncio.run_coroutine_threadsafe(output.put(item), loop)
+
+        def write(chunk):
+            # wait for room in the queue, holding up the scheduler, unless the
+            # job was stopped and its output is no longer read
+            if job.status is None:
+                put((STDOUT, chunk)).result()
+
+        sink = PyGrok.OutputSink(write, PyGrok.FLUSH_SIZE)
+        interpreter = PyGrok.online_interpreter(code, flags, sink)
+        # the job is set before the scheduler can run it and call write()
+        job = Job(interpreter, steps, input_list=input_list, on_done=lambda job: put((DONE, job.status)))
+        scheduler.add(job)
+        if cancelled.is_set():
+            # cancelled before there was a job to cancel
+            scheduler.cancel(job)
+        while True:
+            try:
+                kind, data = await asyncio.wait_for(output.get(), max(deadline - monotonic(), 0))
+            except asyncio.TimeoutError:
+                scheduler.cancel(job)
+                # pass on what the script wrote before it was stopped
+                while True:
+                    kind, data = await output.get()
+                    if kind == DONE:
+                        break
+                    yield kind, data
+                yield DONE, TIMED_OUT
+                return
+            if kind != DONE:
+                yield kind, data
+                continue
+
+            if data == EVICTED:
+                # continue where the scheduler left off, isolated in a worker
+                async for item in stream_from_pool(code, flags, job.remaining_input(),
+                                                   max(deadline - monotonic(), 0), steps,
+                                                   interpreter.snapshot(), cancelled):
+                    yield item
+                return
+            if data == PyGrok.ERROR:
+                yield STDERR, job.message
+            elif data == PyGrok.BUDGET_EXHAUSTED:
+                yield STDERR, f"Code timed out after {steps} steps"
+            yield DONE, data
+            return
+    finally:
+        # stop the script if the run was abandoned in the middle of it
+        if job is not None:
+            scheduler.cancel(job)
+            # let go of the scheduler if it is waiting to queue more output
+            while not output.empty():
+                output.get_nowait()
+            stats["steps"] = stats.get("steps", 0) + interpreter._steps
+            stats["seconds"] = stats.get("seconds", 0) + job.seconds
+            if job.started is not None:
+                stats["scheduler_wait"] = job.started - job.added
+        sessions.finish(session, cancel)
+
+
+async def stream_from_pool(code, flags, input_list, time, steps, snapshot, cancelled):
+    """
+    Run a script on a worker like WorkerPool.stream(), reading the worker's
+    pipe on one of the executor's threads.
+    """
+    loop = asyncio.get_running_loop()
+    output = asyncio.Queue(QUEUED_CHUNKS)
+    abandoned = threading.Event()
+
+    def pump():
+        for item in pool.stream(code, flags, input_list, time, steps, snapshot, cancelled):
+            # wait for room in the queue, so the worker blocks on its pipe
+            # once the script writes faster than its output is read
+            if not abandoned.is_set():
+                asyncio.run_coroutine_threadsafe(output.put(item), loop).result()
+
+    pumping = asyncio.ensure_future(executor.to_thread(pump))
+    finished = False
+    try:
+        while True:
+            kind, data = await output.get()
+            yield kind, data
+            if kind == DONE:
+                finished = True
+                return
+    finally:
+        if not finished:
+            # the run was abandoned in the middle of the script
+            abandoned.set()
+            cancelled.set()
+            while not output.empty():
+                output.get_nowait()
+        await pumping
+
+
+def cacheable(flags):
+    # profiles report timings, which differ from run to run
+    return "p" not in flags
+
+
+def observe_request(endpoint, start):
+    REQUESTS.inc(endpoint=endpoint)
+    REQUEST_SECONDS.observe(monotonic() - start, endpoint=endpoint)
+
+
+INVALID_SESSION = "The session was invalid! You may need to reload your tab."
+
+
+def read_request():
+    """
+    Return the script, flags, input and session a request is for.
+    """
     flags = request.form['flags']
     code = request.form['code'].replace("\r", "")
     input_list = request.form["inputs"].replace("\r", "")
     session = request.form["session"]
+    return code, flags, input_list, session
 
-    if session not in sessions:
-      return {"stdout": "", "stderr": "The session was invalid! You may need to reload your tab."}
-
-    shutil.rmtree(f"sessions/{session}", ignore_errors=True)
-    os.mkdir(f"sessions/{session}")
-
-    with open(f"sessions/{session}/.stdin", "w", encoding="utf-8") as f:
-      f.write(input_list)
-
-    with open(f"sessions/{session}/.stdin", "r", encoding="utf-8") as x:
-      with open(f"sessions/{session}/.stdout", "w", encoding="utf-8") as y:
-        with open(f"sessions/{session}/.stderr", "w", encoding="utf-8") as z:
-            manager = multiprocessing.Manager()
-            ret = manager.dict()
-
-            if "f" in flags:
-                time = 10
-            elif "F" in flags:
-                time = 15
-            elif "b" in flags:
-                time = 30
-            elif "T" in flags:
-                time = 60
-            elif "B" in flags:
-                time = 120
-            else:
-                time = 5
-                
-            ret[1] = ""
-            ret[2] = ""
-            sessions[session] = multiprocessing.Process(target=PyGrok.execute, args=(code, flags, input_list, ret))
-            sessions[session].start()
-            sessions[session].join(time)
-
-
-            if sessions[session].is_alive():
-
-                sessions[session].terminate()
-                if 2 in ret:
-                    ret[2] += "\n" + f"Code timed out after {time} seconds"
-
-            y.write(ret[1])
-            z.write(ret[2])
-    with open(f"sessions/{session}/.stdout", "r", encoding="utf-8") as x:
-        with open(f"sessions/{session}/.stderr", "r", encoding="utf-8") as y:
-            val = {"stdout": x.read(), "stderr": y.read()}
-    shutil.rmtree(f"sessions/{session}", ignore_errors=True)
-    return val
+
+def busy(e, body):
+    """
+    Return a 429 response for a run that was turned away, telling the client
+    when to try again.
+    """
+    REJECTED.inc(reason=e.reason)
+    return {**body, "retry_after": e.retry_after}, 429, {"Retry-After": str(e.retry_after)}
+
+
+def busy_message(e):
+    return f"The server is busy! {e} Try again in {e.retry_after} seconds."
+
+
+def queue_state(run):
+    """
+    Return where a run stands in the admission queue: the runs ahead of it,
+    or None once it is admitted, the runs that were queued when it arrived,
+    and how long it waited, once it is admitted.
+    """
+    ticket = run.admission
+    if ticket is None:
+        # answered from the cache
+        return {"position": None, "depth": 0, "wait": 0}
+    wait = None if ticket.wait is None else round(ticket.wait, 3)
+    return {"position": ticket.position(), "depth": ticket.depth, "wait": wait}
+
+
+def lines(run, offset=0):
+    """
+    Yield a run's output from the given offset as lines of JSON, as it is
+    produced, until the run is over.
+    """
+    while True:
+        events, status, offset = run.read(offset, None)
+        for kind, data in events:
+            yield json.dumps({"stdout" if kind == STDOUT else "stderr": data}) + "\n"
+        if status is not None and not events:
+            return
+
+
+def job_state(run, offset, timeout=0):
+    events, status, offset = run.read(offset, timeout)
+    stdout, stderr = output(events)
+    return {"status": status, "stdout": stdout, "stderr": stderr, "offset": offset, "queue": queue_state(run)}
+
+
+@app.route("/execute", methods=['POST'])
+def execute():
+    start = monotonic()
+    try:
+        code, flags, input_list, session = read_request()
+        if not sessions.touch(session):
+          return {"stdout": "", "stderr": INVALID_SESSION}
+
+        try:
+            run = submit_run(code, flags, input_list, session, request.remote_addr)
+        except QueueFull as e:
+            return busy(e, {"stdout": "", "stderr": busy_message(e)})
+        run.wait()
+        stdout, stderr = output(run.read()[0])
+        return {"stdout": stdout, "stderr": stderr, "queue": queue_state(run)}
+    finally:
+        observe_request("execute", start)
+
+
+@app.route("/execute/stream", methods=['POST'])
+def execute_stream():
+    start = monotonic()
+    code, flags, input_list, session = read_request()
+    if not sessions.touch(session):
+      observe_request("execute_stream", start)
+      return {"stdout": "", "stderr": INVALID_SESSION}
+
+    try:
+        run = submit_run(code, flags, input_list, session, request.remote_addr)
+    except QueueFull as e:
+        observe_request("execute_stream", start)
+        return busy(e, {"stdout": "", "stderr": busy_message(e)})
+
+    def generate():
+        # the request lasts until the whole response has been sent
+        try:
+            # where the run is in the queue, before any of its output
+            yield json.dumps({"queue": queue_state(run)}) + "\n"
+            yield from lines(run)
+        finally:
+            # stop the script if the reader went away in the middle of it
+            if run.status is None:
+                run.cancel()
+            observe_request("execute_stream", start)
+
+    # send each chunk of output as one line of JSON as soon as it arrives
+    return Response(generate(), mimetype="application/x-ndjson")
+
+
+@app.route("/jobs", methods=['POST'])
+def submit_job():
+    start = monotonic()
+    try:
+        code, flags, input_list, session = read_request()
+        if not sessions.touch(session):
+          return {"error": INVALID_SESSION}, 400
+        try:
+            run = submit_run(code, flags, input_list, session, request.remote_addr)
+        except QueueFull as e:
+            return busy(e, {"error": busy_message(e)})
+        return {"job": run.id, "queue": queue_state(run)}, 202
+    finally:
+        observe_request("jobs", start)
+
+
+@app.route("/jobs/<job_id>", methods=['GET'])
+def poll_job(job_id):
+    run = executor.get(job_id)
+    if run is None:
+        return {"error": "No such job"}, 404
+    return job_state(run, request.args.get("offset", 0, type=int))
+
+
+@app.route("/jobs/<job_id>/wait", methods=['GET'])
+def wait_job(job_id):
+    run = executor.get(job_id)
+    if run is None:
+        return {"error": "No such job"}, 404
+    offset = request.args.get("offset", 0, type=int)
+    timeout = min(request.args.get("timeout", MAX_WAIT, type=float), MAX_WAIT)
+    # answer as soon as there is new output, or the job is over
+    return job_state(run, offset, max(timeout, 0))
+
+
+@app.route("/jobs/<job_id>/stream", methods=['GET'])
+def stream_job(job_id):
+    run = executor.get(job_id)
+    if run is None:
+        return {"error": "No such job"}, 404
+    # the job keeps going if the reader goes away, to be picked up again later
+    return Response(lines(run, request.args.get("offset", 0, type=int)), mimetype="application/x-ndjson")
+
+
+@app.route("/jobs/<job_id>", methods=['DELETE'])
+def cancel_job(job_id):
+    run = executor.get(job_id)
+    if run is None:
+        return {"error": "No such job"}, 404
+    run.cancel()
+    return {"status": run.status}
+
+
+@app.route("/cache/stats", methods=['GET'])
+def cache_stats():
+    return cache.stats()
+
+
+@app.route("/metrics", methods=['GET'])
+def metrics_page():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 
 @app.route('/commit', methods=['POST'])
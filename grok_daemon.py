@@ -0,0 +1,203 @@
+#!/usr/bin/python
+
+"""
+Warm daemon for the PyGrok command line, and a thin client for it. The
+daemon keeps PyGrok and everything it imports loaded, and forks a copy of
+itself for each run, so a run skips Python's start-up and the imports. The
+client hands the daemon its arguments, its working directory and its own
+stdin, stdout and stderr, so the script reads and writes those directly,
+just like it would in-process. When no daemon is running, the client runs
+the script in-process instead.
+Usage:
+    ./grok_daemon.py --serve [<socket>]     start the daemon
+    ./grok_daemon.py <PyGrok.py arguments>  run a script through it
+The socket is $GROK_SOCKET, or pygrok.sock in $XDG_RUNTIME_DIR, or
+/tmp/pygrok-<uid>.sock without either.
+"""
+
+import os
+import struct
+import sys
+# the client uses the C modules behind socket and signal, which start several
+# times faster, as they skip importing enum and selectors
+import _signal
+import _socket
+
+# a request is a header with the length of the arguments, sent along with
+# the client's standard streams, followed by the working directory and the
+# arguments, separated by nulls
+HEADER = struct.Struct("!I")
+# the daemon answers with the pid of the child running the script, and then
+# the script's exit status
+STATUS = struct.Struct("!i")
+
+
+def socket_path():
+    """
+    Return the path of the daemon's socket.
+    """
+    if os.environ.get("GROK_SOCKET"):
+        return os.environ["GROK_SOCKET"]
+    if os.environ.get("XDG_RUNTIME_DIR"):
+        return os.path.join(os.environ["XDG_RUNTIME_DIR"], "pygrok.sock")
+    return os.path.join("/tmp", f"pygrok-{os.getuid()}.sock")
+
+
+def serve(path=None):
+    """
+    Listen for runs on a Unix socket until interrupted or terminated, running
+    each one in a forked child of the daemon.
+    """
+    import contextlib, io, signal, socket
+    import PyGrok
+    # modules the command line only imports once it needs them
+    import argparse, json, mmap, termios, traceback, tty
+
+    # run a script once, so that whatever the command line sets up on its
+    # first run, like argparse's regular expressions, is ready in every child
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        try:
+            PyGrok.main(["-c", "q"])
+        except SystemExit:
+            pass
+
+    path = path or socket_path()
+    # only take over the socket of a daemon that is gone, which refuses
+    # connections, and not one that is still running
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except FileNotFoundError:
+        pass
+    except ConnectionRefusedError:
+        os.unlink(path)
+    else:
+        sys.exit(f"grok_daemon: a daemon is already listening on {path}")
+    finally:
+        probe.close()
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # only the daemon's user may connect
+    umask = os.umask(0o177)
+    try:
+        listener.bind(path)
+    finally:
+        os.umask(umask)
+    listener.listen(64)
+    # reap children automatically, and remove the socket when stopped
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    try:
+        while True:
+            conn, _ = listener.accept()
+            if os.fork() == 0:
+                listener.close()
+                # batch runs wait for their own worker processes, and Ctrl-C
+                # raises KeyboardInterrupt, however the daemon was started
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.default_int_handler)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                status = 1
+                try:
+                    status = _run(conn, PyGrok.main)
+                finally:
+                    # leave without the daemon's cleanup, like removing the
+                    # socket
+                    os._exit(status)
+            conn.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        os.unlink(path)
+
+
+def _run(conn, main):
+    """
+    Run one request in a forked child, and return its exit status.
+    """
+    import socket, traceback
+
+    data, fds, _, _ = socket.recv_fds(conn, HEADER.size, 3)
+    if not data:
+        # the connection was only checking that the daemon is running
+        return 0
+    (length,) = HEADER.unpack(_recv_exactly(conn, HEADER.size, data))
+    cwd, *argv = _recv_exactly(conn, length).decode("utf-8", "surrogateescape").split("\0")
+    conn.sendall(STATUS.pack(os.getpid()))
+
+    # take over the client's standard streams, buffered like Python would
+    for fd, target in zip(fds, (0, 1, 2)):
+        os.dup2(fd, target)
+        os.close(fd)
+    sys.stdin = open(0, "r", closefd=False)
+    sys.stdout = open(1, "w", buffering=1 if os.isatty(1) else -1, closefd=False)
+    sys.stderr = open(2, "w", buffering=1, errors="backslashreplace", closefd=False)
+    os.chdir(cwd)
+    sys.argv = argv
+
+    try:
+        main(argv[1:])
+        status = 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            status = e.code or 0
+        else:
+            sys.stderr.write(f"{e.code}\n")
+            status = 1
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    conn.sendall(STATUS.pack(status))
+    return status
+
+
+def _recv_exactly(conn, size, data=b""):
+    """
+    Receive data from a socket until there is size bytes of it.
+    """
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise EOFError
+        data += chunk
+    return data
+
+
+def run(argv):
+    """
+    Run the command line with the given arguments, including the program
+    name, through the daemon if there is one, and exit with its status.
+    """
+    conn = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path())
+    except OSError:
+        # no daemon running
+        conn.close()
+        import PyGrok
+        PyGrok.main(argv[1:])
+        sys.exit()
+
+    payload = "\0".join([os.getcwd()] + argv).encode("utf-8", "surrogateescape")
+    # pass on stdin, stdout and stderr themselves (see socket.send_fds)
+    conn.sendmsg([HEADER.pack(len(payload))], [(_socket.SOL_SOCKET, _socket.SCM_RIGHTS, struct.pack("3i", 0, 1, 2))])
+    conn.sendall(payload)
+    try:
+        (pid,) = STATUS.unpack(_recv_exactly(conn, STATUS.size))
+        # Ctrl-C interrupts the script, not just the client
+        forward = lambda signum, frame: os.kill(pid, signum)
+        _signal.signal(_signal.SIGINT, forward)
+        _signal.signal(_signal.SIGTERM, forward)
+        (status,) = STATUS.unpack(_recv_exactly(conn, STATUS.size))
+    except EOFError:
+        sys.exit("grok_daemon: the daemon stopped before the script finished")
+    sys.exit(status)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--serve"]:
+        serve(sys.argv[2] if len(sys.argv) > 2 else None)
+    else:
+        run(sys.argv)
@@ -0,0 +1,87 @@
+#!/usr/bin/python
+
+"""
+Show the state of a run recorded with PyGrok.py --record after any of its
+steps, without running the script again.
+Usage:
+    ./grok_replay.py <recording>                  show which steps it has
+    ./grok_replay.py <recording> <step> [...]     show the state after them
+Negative steps count back from the end of the recording, so -1 is the state
+the run stopped in.
+"""
+
+import argparse
+import sys
+
+import PyGrok
+
+NAMES = {PyGrok.DIRECTIONS["l"]: "right", PyGrok.DIRECTIONS["h"]: "left",
+         PyGrok.DIRECTIONS["j"]: "down", PyGrok.DIRECTIONS["k"]: "up"}
+
+
+def describe(recording, state, top):
+    """
+    Return a description of a RecordedState: where the run is in the script,
+    the register and the top values of the stack, or all of them if top is 0.
+    """
+    x, y = state.position
+    # the instruction is None for skipped cells, and before the first step
+    instruction = "nothing executed" if state.instruction is None else repr(state.instruction)
+    lines = ["Step {} at ({}, {}) moving {}, {}".format(state.step, x, y, NAMES[state.direction], instruction)]
+    rows = recording.code.split("\n")
+    if x >= 0 and 0 <= y < len(rows):
+        lines.append("    " + rows[y])
+        lines.append("    " + " " * x + "^")
+    lines.append("Register: {!r}".format(state.register))
+    stack = state.stack
+    if top and len(stack) > top:
+        lines.append("Stack: [... {} more, {}]".format(len(stack) - top, ", ".join(map(repr, stack[-top:]))))
+    else:
+        lines.append("Stack: {!r}".format(stack))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    """
+    Run the command line interface.
+    Arguments:
+        argv -- the arguments, not counting the program name (default:
+                sys.argv[1:])
+    """
+    parser = argparse.ArgumentParser(description="Show the state of a recorded Grok run after any of its steps.")
+    parser.add_argument("recording",
+                        type=argparse.FileType("rb"),
+                        help="file written by PyGrok.py --record")
+    parser.add_argument("steps",
+                        type=int,
+                        nargs="*",
+                        metavar="step",
+                        help="steps to show the state after, counting back from the end if negative")
+    parser.add_argument("--top",
+                        type=int,
+                        default=16,
+                        metavar="<count>",
+                        help="the number of stack values to show, from the top, or 0 for all of them (default: %(default)s)")
+    arguments = parser.parse_args(argv)
+
+    try:
+        recording = PyGrok.Recording(arguments.recording)
+    except ValueError as e:
+        parser.error("can't read {}: {}".format(arguments.recording.name, e))
+
+    if not arguments.steps:
+        sys.stdout.write("Steps {} to {}, in {} chunks with {} snapshots\n".format(
+            recording.first, recording.last, len(recording._firsts), len(recording._snapshots)))
+        return
+    for number, step in enumerate(arguments.steps):
+        if step < 0:
+            step += recording.last + 1
+        try:
+            state = recording.state(step)
+        except IndexError as e:
+            parser.error(str(e))
+        sys.stdout.write(("\n" if number else "") + describe(recording, state, arguments.top) + "\n")
+
+
+if __name__ == "__main__":
+    main()
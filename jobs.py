@@ -0,0 +1,201 @@
+"""
+Asynchronous runs for the online interpreter. Submitting a run returns at
+once with its id, while the run carries on in the background; its output can
+then be polled, awaited or streamed by later requests. Runs are coroutines
+on one asyncio event loop, so a run waiting on the scheduler or a worker
+doesn't hold a thread, and a single process can have thousands going at
+once.
+"""
+
+import asyncio
+import itertools
+import secrets
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from worker_pool import STDERR, DONE, CRASHED
+
+# read in place of output that is no longer kept
+TRUNCATED = "[Earlier output was dropped]\n"
+
+
+class Run:
+    """
+    A submitted run: the output it has produced so far, and its status once
+    it is over. Any thread can follow it.
+    """
+    def __init__(self, max_output=None):
+        """
+        Arguments:
+            max_output -- the most characters of output kept for the run's
+                          readers. Past it, the oldest output is dropped
+                          (default: unlimited)
+        """
+        self.id = secrets.token_hex(16)
+        # (kind, data) pairs, where kind is STDOUT or STDERR, after the first
+        # dropped ones, which are no longer kept
+        self.events = deque()
+        self.dropped = 0
+        self._max_output = max_output
+        self._kept = 0
+        # set once the run is over
+        self.status = None
+        self.finished = None
+        # whether cancel() was called
+        self.cancelled = False
+        # stops the run; set by whatever runs it
+        self.on_cancel = lambda: None
+        # the run's place in the admission queue (see admission.Ticket), if
+        # it needed one
+        self.admission = None
+        self._changed = threading.Condition()
+
+    @property
+    def end(self):
+        """
+        The number of events the run has emitted, including dropped ones.
+        """
+        return self.dropped + len(self.events)
+
+    def emit(self, kind, data):
+        """
+        Add a chunk of output, or finish the run if kind is DONE, in which
+        case data is its status.
+        """
+        with self._changed:
+            if kind == DONE:
+                self.status = data
+                self.finished = time.monotonic()
+            else:
+                self.events.append((kind, data))
+                self._kept += len(data)
+                if self._max_output is not None and self._kept > self._max_output:
+                    self._drop()
+            self._changed.notify_all()
+
+    def cancel(self):
+        """
+        Stop the run, if it isn't over yet.
+        """
+        self.cancelled = True
+        self.on_cancel()
+
+    def read(self, offset=0, timeout=0):
+        """
+        Return the events after the first offset ones, the run's status and
+        the offset to read on from. If there are none yet and the run isn't
+        over, wait up to timeout seconds for either, or for as long as it
+        takes if timeout is None. Reading from before the events that were
+        dropped starts with TRUNCATED instead of them.
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: self.end > offset or self.status is not None, timeout)
+            events = list(itertools.islice(self.events, max(offset - self.dropped, 0), None))
+            if offset < self.dropped:
+                events.insert(0, (STDERR, TRUNCATED))
+            return events, self.status, max(offset, self.end)
+
+    def wait(self, timeout=None):
+        """
+        Wait for the run to be over, and return whether it is.
+        """
+        with self._changed:
+            return self._changed.wait_for(lambda: self.status is not None, timeout)
+
+    def _drop(self):
+        """
+        Drop the oldest events until the rest fit in max_output, keeping at
+        least the newest one.
+        """
+        while self._kept > self._max_output and len(self.events) > 1:
+            self._kept -= len(self.events.popleft()[1])
+            self.dropped += 1
+
+
+class RunExecutor:
+    """
+    Drives runs on an asyncio event loop in a background thread, and keeps
+    them around for their readers until a while after they are over.
+    """
+    def __init__(self, threads=4, max_runs=10000, ttl=300, max_output=None):
+        """
+        Arguments:
+            threads -- the number of threads running blocking calls for the
+                       runs (see to_thread())
+            max_runs -- the most finished runs kept at once. The oldest ones
+                        are dropped first
+            ttl -- how long a run is kept after it is over, in seconds
+            max_output -- the most characters of output kept for each run
+                          (default: unlimited; see Run)
+        """
+        self._max_runs = max_runs
+        self._ttl = ttl
+        self._max_output = max_output
+        # id -> run
+        self._runs = {}
+        # id -> when it finished, for the runs that are over, in that order
+        self._finished = OrderedDict()
+        self._lock = threading.Lock()
+        self._threads = ThreadPoolExecutor(threads)
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+
+    def submit(self, function):
+        """
+        Start a run, and return it straight away.
+        Arguments:
+            function -- an async function called with the Run, which emits
+                        its output and finishes it with DONE
+        """
+        run = Run(self._max_output)
+        with self._lock:
+            self._expire()
+            self._runs[run.id] = run
+        asyncio.run_coroutine_threadsafe(self._drive(run, function), self._loop)
+        return run
+
+    def get(self, run_id):
+        """
+        Return the run with the given id, or None if there is none.
+        """
+        with self._lock:
+            self._expire()
+            return self._runs.get(run_id)
+
+    async def to_thread(self, function, *args):
+        """
+        Call a blocking function on one of the executor's threads, and return
+        its result. Calls wait for a free thread rather than starting more.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self._threads, function, *args)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._runs)
+
+    async def _drive(self, run, function):
+        try:
+            await function(run)
+        except Exception as e:
+            if run.status is None:
+                run.emit(STDERR, f"{e}")
+        finally:
+            if run.status is None:
+                run.emit(DONE, CRASHED)
+            with self._lock:
+                self._finished[run.id] = run.finished
+
+    def _expire(self):
+        """
+        Drop runs that have been over for longer than the TTL, and the ones
+        that finished first while too many are kept.
+        """
+        now = time.monotonic()
+        while self._finished:
+            run_id, finished = next(iter(self._finished.items()))
+            if now - finished <= self._ttl and len(self._finished) <= self._max_runs:
+                break
+            del self._finished[run_id]
+            del self._runs[run_id]
@@ -0,0 +1,173 @@
+"""
+Metrics of the online interpreter in the Prometheus text format, for
+/metrics to be scraped. Only covers what the server needs: counters, gauges
+and histograms, each optionally split up by labels.
+"""
+
+import threading
+
+# upper bounds of the default histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+               for _, value in pairs)
+    return "{" + ",".join('{}="{}"'.format(name, value) for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Metric:
+    """
+    A named metric with a value for each combination of its labels.
+    """
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        """
+        Arguments:
+            name -- the name the metric is exported as
+            help -- a description of the metric
+            labels -- the names of the labels it is split up by
+        """
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        # label values -> value
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError("{} takes the labels {}".format(self.name, ", ".join(self.labels)))
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def render(self):
+        """
+        Return the metric in the Prometheus text format.
+        """
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.kind)]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.extend(self._render_value(key, value))
+        return "\n".join(lines) + "\n"
+
+    def _render_value(self, key, value):
+        yield "{}{} {}".format(self.name, _format_labels(self.labels, key), _format_value(value))
+
+
+class Counter(Metric):
+    """
+    A count that only ever goes up.
+    """
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value that is set as it changes, or read from a function whenever the
+    metrics are rendered.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), function=None):
+        """
+        Arguments:
+            function -- returns the value, or a dict of label values to
+                        values if the gauge has labels (default: set())
+        """
+        super().__init__(name, help, labels)
+        self._function = function
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def render(self):
+        if self._function is not None:
+            values = self._function()
+            with self._lock:
+                if self.labels:
+                    self._values = {key if isinstance(key, tuple) else (key,): value
+                                    for key, value in values.items()}
+                else:
+                    self._values = {(): values}
+        return super().render()
+
+
+class Histogram(Metric):
+    """
+    Counts of observed values by the buckets they fall into, along with their
+    sum and count.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        """
+        Arguments:
+            buckets -- the upper bounds of the buckets, in increasing order
+        """
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # a count per bucket, then the sum
+                counts = self._values[key] = [0] * len(self.buckets) + [0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-1] += value
+
+    def _render_value(self, key, counts):
+        # buckets are cumulative in the exposition format
+        total = 0
+        for bound, count in zip(self.buckets, counts):
+            total += count
+            yield "{}_bucket{} {}".format(self.name, _format_labels(self.labels, key, [("le", _format_value(bound))]),
+                                          total)
+        labels = _format_labels(self.labels, key)
+        yield "{}_sum{} {}".format(self.name, labels, _format_value(counts[-1]))
+        yield "{}_count{} {}".format(self.name, labels, total)
+
+
+class Registry:
+    """
+    The metrics exported together.
+    """
+    def __init__(self):
+        self._metrics = []
+
+    def add(self, metric):
+        """
+        Export a metric, and return it.
+        """
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        Return every metric in the Prometheus text format.
+        """
+        return "".join(metric.render() for metric in self._metrics)
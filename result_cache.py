@@ -0,0 +1,171 @@
+"""
+Cache of results from the online interpreter. Grok scripts are
+deterministic, so a run's output only depends on its code, flags and input,
+and repeated runs of shared links and examples can be answered without
+running them again.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+
+def cache_key(code, flags, input_list):
+    """
+    Return the key a run is cached under: a hash of everything its output
+    depends on.
+    """
+    # encoded as a JSON list, so that no two runs share a key however their
+    # fields split up
+    data = json.dumps([code, flags, input_list]).encode("utf-8", "surrogatepass")
+    return hashlib.sha256(data).hexdigest()
+
+
+class ResultCache:
+    """
+    Bounded cache of (stdout, stderr) pairs, evicting the least recently used
+    entries once it holds more than max_entries entries or max_bytes bytes of
+    output. Entries can also be kept on disk, one file each, so that they
+    survive a restart.
+    """
+    def __init__(self, max_entries=1000, max_bytes=64 * 1024 * 1024, directory=None):
+        """
+        Arguments:
+            max_entries -- the most results kept at once
+            max_bytes -- the most output kept at once, in bytes
+            directory -- where results are saved, if they should be
+        """
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._directory = directory
+        # key -> (stdout, stderr, size), least recently used first
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._load()
+
+    def get(self, key):
+        """
+        Return the cached (stdout, stderr) of a run, or None if it isn't
+        cached.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+        if self._directory:
+            # file times keep the order of use across restarts
+            try:
+                os.utime(self._path(key))
+            except OSError:
+                pass
+        return entry[0], entry[1]
+
+    def put(self, key, stdout, stderr):
+        """
+        Cache the output of a run. Only cache runs that halted on their own,
+        as runs that timed out depend on how busy the server was.
+        """
+        size = len(stdout.encode("utf-8", "surrogatepass")) + len(stderr.encode("utf-8", "surrogatepass"))
+        if size > self._max_bytes:
+            return
+        with self._lock:
+            self._add(key, stdout, stderr, size)
+            evicted = self._evict()
+        if self._directory:
+            self._save(key, stdout, stderr)
+            for old in evicted:
+                try:
+                    os.remove(self._path(old))
+                except OSError:
+                    pass
+
+    def stats(self):
+        """
+        Return the cache's counters and current size.
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "entries": len(self._entries), "bytes": self._bytes}
+
+    def _add(self, key, stdout, stderr, size):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= old[2]
+        self._entries[key] = (stdout, stderr, size)
+        self._bytes += size
+
+    def _evict(self):
+        """
+        Drop least recently used entries until the cache is within its limits,
+        and return their keys.
+        """
+        evicted = []
+        while len(self._entries) > self._max_entries or self._bytes > self._max_bytes:
+            key, (_, _, size) = self._entries.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+            evicted.append(key)
+        return evicted
+
+    def _path(self, key):
+        return os.path.join(self._directory, key + ".json")
+
+    def _save(self, key, stdout, stderr):
+        # write to a temporary file first, so that a crash never leaves a
+        # half-written entry behind
+        path = self._path(key)
+        temp = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        try:
+            with open(temp, "w", encoding="utf-8") as f:
+                json.dump({"stdout": stdout, "stderr": stderr}, f)
+            os.replace(temp, path)
+        except OSError:
+            pass
+
+    def _load(self):
+        """
+        Read the entries saved in the cache directory, least recently used
+        first.
+        """
+        files = []
+        for name in os.listdir(self._directory):
+            path = os.path.join(self._directory, name)
+            if name.endswith(".tmp"):
+                # left over from a crash
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            elif name.endswith(".json"):
+                try:
+                    files.append((os.path.getmtime(path), name[:-len(".json")]))
+                except OSError:
+                    pass
+
+        for _, key in sorted(files):
+            try:
+                with open(self._path(key), encoding="utf-8") as f:
+                    entry = json.load(f)
+                stdout, stderr = entry["stdout"], entry["stderr"]
+            except (OSError, ValueError, KeyError, TypeError):
+                continue
+            size = len(stdout.encode("utf-8", "surrogatepass")) + len(stderr.encode("utf-8", "surrogatepass"))
+            self._add(key, stdout, stderr, size)
+        for key in self._evict():
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+        self.evictions = 0
@@ -0,0 +1,256 @@
+"""
+Cooperative scheduler running many scripts in one process. Each script gets
+a slice of steps in turn, so a host can serve many runs at once without a
+process for each of them.
+"""
+
+import heapq
+import threading
+import time
+from collections import deque
+
+import PyGrok
+
+# statuses of jobs that didn't finish on the scheduler, besides the ones
+# returned by Interpreter.run()
+CANCELLED = "cancelled"
+EVICTED = "evicted"
+
+
+class Job:
+    """
+    A script run by a Scheduler, with its own input and output.
+    """
+    def __init__(self, interpreter, max_steps=None, weight=1, input_list=None, on_done=None):
+        """
+        Arguments:
+            interpreter -- the interpreter to run. Its input is replaced by
+                           the job's, which feed() adds to
+            max_steps -- the number of steps the script may run for (default:
+                         unlimited)
+            weight -- the job's share of steps relative to other jobs
+            input_list -- the script's whole input, one line per ':'
+                          instruction, if it is known up front. Otherwise
+                          the script waits for input until close_input()
+            on_done -- a function called with the job once it is finished
+        """
+        self.interpreter = interpreter
+        self.max_steps = max_steps
+        self.weight = weight
+        # set once the job is finished
+        self.status = None
+        self.message = None
+        self.done = threading.Event()
+        # when the job was added and first run, and the time spent running it
+        self.added = None
+        self.started = None
+        self.seconds = 0
+        self._on_done = on_done
+
+        self._input = deque()
+        self._input_closed = False
+        if input_list is not None:
+            self._input.extend(input_list.split("\n"))
+            self._input_closed = True
+        interpreter._read = self._read_line
+
+        self._scheduler = None
+        # virtual time, the steps run so far divided by the weight
+        self._pass = 0
+
+    def feed(self, line):
+        """
+        Add a line of input, waking the script up if it was waiting for one.
+        """
+        self._input.append(line)
+        if self._scheduler:
+            self._scheduler._wake(self)
+
+    def close_input(self):
+        """
+        Mark the end of the input. Input instructions read "0" from now on.
+        """
+        self._input_closed = True
+        if self._scheduler:
+            self._scheduler._wake(self)
+
+    def remaining_input(self):
+        """
+        Return the lines of input the script hasn't read yet.
+        """
+        return list(self._input)
+
+    def _read_line(self):
+        if self._input:
+            return self._input.popleft()
+        return "0" if self._input_closed else None
+
+    def _readable(self):
+        return bool(self._input) or self._input_closed
+
+    def __lt__(self, other):
+        # jobs with equal passes are ordered arbitrarily in the run queue
+        return False
+
+
+class Scheduler:
+    """
+    Runs jobs a slice of steps at a time, always continuing the job that has
+    had the fewest steps relative to its weight (stride scheduling), which is
+    round-robin when all weights are equal.
+
+    A step that takes a long time can't be interrupted, as everything runs in
+    one thread. Jobs that run for more than evict_steps steps, take longer
+    than evict_seconds for one slice or grow an integer past evict_bits bits,
+    which makes every step on it slower, are evicted instead, so that the
+    caller can move them somewhere isolated, like a separate process, using
+    a snapshot of their state.
+    """
+    def __init__(self, slice_steps=10000, evict_steps=None, evict_seconds=None, evict_bits=None):
+        """
+        Arguments:
+            slice_steps -- the number of steps a job runs before the next one
+                           gets its turn, times its weight
+            evict_steps -- how many steps a job may run here (default:
+                           unlimited)
+            evict_seconds -- how long a single slice may take (default:
+                             unlimited)
+            evict_bits -- how many bits an integer may grow to here, which
+                          bounds the time a step can take (default:
+                          unlimited)
+        """
+        self._slice_steps = slice_steps
+        self._evict_steps = evict_steps
+        self._evict_seconds = evict_seconds
+        self._evict_bits = evict_bits
+        # jobs ready to run, as (pass, job)
+        self._ready = []
+        # jobs waiting for input
+        self._waiting = set()
+        self._lock = threading.Condition()
+        self._closed = False
+
+    def add(self, job):
+        """
+        Schedule a job, and return it.
+        """
+        # the interpreter stops as soon as an integer is too large, instead
+        # of carrying on with slower and slower steps
+        job.interpreter._max_bits = self._evict_bits
+        with self._lock:
+            job._scheduler = self
+            job.added = time.monotonic()
+            # start new jobs level with the others, so they don't get to
+            # catch up on the steps they weren't around for
+            job._pass = self._ready[0][0] if self._ready else 0
+            heapq.heappush(self._ready, (job._pass, job))
+            self._lock.notify()
+        return job
+
+    def cancel(self, job):
+        """
+        Stop a job at the end of its current slice.
+        """
+        with self._lock:
+            if job.status is not None:
+                return
+            if job in self._waiting:
+                self._waiting.discard(job)
+            else:
+                self._ready = [(p, j) for p, j in self._ready if j is not job]
+                heapq.heapify(self._ready)
+            self._finish(job, CANCELLED)
+
+    def run_slice(self):
+        """
+        Run one slice of the next job. Returns False if no job is ready.
+        """
+        with self._lock:
+            if not self._ready:
+                return False
+            _, job = heapq.heappop(self._ready)
+
+        interpreter = job.interpreter
+        steps = self._slice_steps * job.weight
+        if job.max_steps is not None:
+            steps = min(steps, job.max_steps - interpreter._steps)
+        if self._evict_steps is not None:
+            steps = min(steps, self._evict_steps - interpreter._steps)
+        before = interpreter._steps
+        start = time.monotonic()
+        if job.started is None:
+            job.started = start
+        try:
+            status = interpreter.run(steps)
+            message = interpreter._message
+        except Exception as e:
+            # real error messages are raised in debug mode
+            status = PyGrok.ERROR
+            message = f"{e}"
+        seconds = time.monotonic() - start
+        job.seconds += seconds
+        interpreter._sink.flush()
+
+        with self._lock:
+            if job.status is not None:
+                # cancelled while running
+                return True
+            if status == PyGrok.HALTED:
+                self._finish(job, PyGrok.ERROR if message else PyGrok.HALTED, message)
+            elif status == PyGrok.ERROR:
+                self._finish(job, status, message)
+            elif job.max_steps is not None and interpreter._steps >= job.max_steps:
+                self._finish(job, PyGrok.BUDGET_EXHAUSTED)
+            elif (status == PyGrok.VALUE_TOO_LARGE
+                    or (self._evict_steps is not None and interpreter._steps >= self._evict_steps)
+                    or (self._evict_seconds is not None and seconds > self._evict_seconds)):
+                self._finish(job, EVICTED)
+            else:
+                job._pass += (interpreter._steps - before + 1) / job.weight
+                if status == PyGrok.AWAITING_INPUT and not job._readable():
+                    self._waiting.add(job)
+                else:
+                    heapq.heappush(self._ready, (job._pass, job))
+        return True
+
+    def run(self):
+        """
+        Run jobs until none of them are ready.
+        """
+        while self.run_slice():
+            pass
+
+    def serve(self):
+        """
+        Run jobs as they are added, until close() is called. Meant to be the
+        target of a thread.
+        """
+        while True:
+            with self._lock:
+                while not self._ready and not self._closed:
+                    self._lock.wait()
+                if self._closed:
+                    return
+            self.run_slice()
+
+    def close(self):
+        """
+        Stop serve(), leaving unfinished jobs as they are.
+        """
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+
+    def _wake(self, job):
+        with self._lock:
+            if job in self._waiting:
+                self._waiting.discard(job)
+                heapq.heappush(self._ready, (job._pass, job))
+                self._lock.notify()
+
+    def _finish(self, job, status, message=None):
+        job.status = status
+        job.message = message
+        job.done.set()
+        if job._on_done:
+            job._on_done(job)
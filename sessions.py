@@ -0,0 +1,116 @@
+"""
+Registry of the online interpreter's sessions, one for each open page.
+Sessions expire once they haven't been used for a while, and only the most
+recently used ones are kept, so the registry stays the same size however
+long the server runs. A session runs one script at a time: starting a run
+cancels the one before it.
+"""
+
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+
+class SessionRegistry:
+    """
+    Bounded set of session tokens, each with the run it has going, if any.
+    """
+    def __init__(self, ttl=24 * 60 * 60, max_sessions=10000):
+        """
+        Arguments:
+            ttl -- how long a session lasts without being used, in seconds
+            max_sessions -- the most sessions kept at once. The least recently
+                            used ones are dropped first
+        """
+        self._ttl = ttl
+        self._max_sessions = max_sessions
+        # token -> [time last used, function cancelling its run], least
+        # recently used first
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self):
+        """
+        Start a new session, and return its token.
+        """
+        token = secrets.token_hex(64)
+        with self._lock:
+            self._sessions[token] = [time.monotonic(), None]
+            dropped = self._expire()
+        self._cancel(dropped)
+        return token
+
+    def touch(self, token):
+        """
+        Mark a session as used, leaving its run be. Returns False if the
+        session doesn't exist.
+        """
+        with self._lock:
+            entry, dropped = self._use(token)
+        self._cancel(dropped)
+        return entry is not None
+
+    def start(self, token, cancel):
+        """
+        Record a run a session has started, cancelling its previous run if
+        that is still going. Returns False if the session doesn't exist.
+        Arguments:
+            token -- the session's token
+            cancel -- a function stopping the new run, or None if there is
+                      nothing to stop
+        """
+        with self._lock:
+            entry, dropped = self._use(token)
+            if entry is not None:
+                dropped.append(entry[1])
+                entry[1] = cancel
+        # cancel outside the lock, as stopping a run may take a moment
+        self._cancel(dropped)
+        return entry is not None
+
+    def finish(self, token, cancel):
+        """
+        Forget a run once it is over, unless a newer one has replaced it.
+        """
+        with self._lock:
+            entry = self._sessions.get(token)
+            if entry is not None and entry[1] is cancel:
+                entry[1] = None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def _use(self, token):
+        """
+        Mark a session as used, and return its entry, or None if it doesn't
+        exist or has expired, along with the cancel functions of the sessions
+        dropped on the way.
+        """
+        dropped = self._expire()
+        entry = self._sessions.get(token)
+        if entry is not None:
+            entry[0] = time.monotonic()
+            self._sessions.move_to_end(token)
+        return entry, dropped
+
+    def _expire(self):
+        """
+        Drop expired sessions, and the least recently used ones while there
+        are too many, and return the functions cancelling their runs.
+        """
+        dropped = []
+        now = time.monotonic()
+        while self._sessions:
+            token, (used, cancel) = next(iter(self._sessions.items()))
+            if now - used <= self._ttl and len(self._sessions) <= self._max_sessions:
+                break
+            del self._sessions[token]
+            dropped.append(cancel)
+        return dropped
+
+    def _cancel(self, cancels):
+        for cancel in cancels:
+            if cancel:
+                cancel()
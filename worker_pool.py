@@ -0,0 +1,252 @@
+"""
+Pool of warm worker processes for running scripts from the online interpreter.
+Workers are forked once with PyGrok already imported, and receive jobs and
+send back output over pipes, so a request costs one message exchange instead
+of starting new processes.
+"""
+
+import multiprocessing
+import signal
+import sys
+import threading
+import time
+
+import PyGrok
+
+# messages sent from a worker back to the pool
+STDOUT = 1
+STDERR = 2
+DONE = 3
+# a dict of counters describing the run, like the steps it took (see
+# PyGrok.stream_execute) or how long it waited for a worker
+STATS = 4
+
+# statuses of scripts that didn't finish in the worker, besides the ones
+# returned by PyGrok.stream_execute()
+TIMED_OUT = "timed out"
+CRASHED = "crashed"
+CANCELLED = "cancelled"
+
+# how long a terminated worker gets to flush the output it has buffered
+FLUSH_GRACE = 1
+# how often a running script checks whether it has been cancelled
+CANCEL_POLL = 0.1
+
+
+def _work(conn):
+    """
+    Main loop of a worker process: run jobs until the pool closes the pipe.
+    """
+    # flush the buffered output when the pool terminates a run that timed
+    # out. only workers do this, as they are the pool's to terminate
+    signal.signal(signal.SIGTERM, _terminate)
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        code, flags, input_list, max_steps, snapshot = job
+        stats = {}
+        try:
+            status = PyGrok.stream_execute(code, flags, input_list,
+                                           lambda chunk: conn.send((STDOUT, chunk)),
+                                           lambda message: conn.send((STDERR, message)),
+                                           max_steps, snapshot, stats)
+        finally:
+            # also sent by scripts terminated for timing out
+            conn.send((STATS, stats))
+        conn.send((DONE, status))
+
+
+def _terminate(signum, frame):
+    # leave PyGrok.stream_execute() through its cleanup code instead of dying
+    # on the spot
+    sys.exit()
+
+
+class Worker:
+    """
+    A single worker process and the pipe used to talk to it.
+    """
+    def __init__(self):
+        self._conn, child_conn = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=_work, args=(child_conn,), daemon=True)
+        self._process.start()
+        child_conn.close()
+        self.jobs = 0
+        self.alive = True
+
+    def run(self, code, flags, input_list, timeout, max_steps=None, snapshot=None, cancelled=None):
+        """
+        Run a script for up to timeout seconds and max_steps steps, and return
+        its output, its error message, and its status (see stream()). A
+        worker that times out is killed and can't be reused. If a snapshot is
+        given, the script continues from it (see PyGrok.stream_execute). If
+        the cancelled event is set, the script is stopped like one that timed
+        out.
+        """
+        output = {STDOUT: [], STDERR: []}
+        for kind, data in self.stream(code, flags, input_list, timeout, max_steps, snapshot, cancelled):
+            if kind == DONE:
+                status = data
+            elif kind != STATS:
+                output[kind].append(data)
+        return "".join(output[STDOUT]), "".join(output[STDERR]), status
+
+    def stream(self, code, flags, input_list, timeout, max_steps=None, snapshot=None, cancelled=None):
+        """
+        Run a script like run(), but yield its output as (STDOUT, chunk) and
+        (STDERR, message) pairs as soon as the worker sends them, and
+        (STATS, stats) once it stops, followed by (DONE, status), where status
+        is TIMED_OUT, CANCELLED, CRASHED or the status returned by
+        PyGrok.stream_execute(). The worker blocks while its pipe is full, so a
+        slow reader holds back the script instead of letting its output pile
+        up in memory.
+        """
+        self.jobs += 1
+        self._conn.send((code, flags, input_list, max_steps, snapshot))
+        deadline = time.monotonic() + timeout
+        finished = False
+        status = TIMED_OUT
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                if cancelled is not None:
+                    if cancelled.is_set():
+                        status = CANCELLED
+                        break
+                    remaining = min(remaining, CANCEL_POLL)
+                if not self._conn.poll(remaining):
+                    continue
+                try:
+                    kind, data = self._conn.recv()
+                except EOFError:
+                    # the worker died
+                    self.close()
+                    finished = True
+                    yield DONE, CRASHED
+                    return
+                if kind == DONE:
+                    finished = True
+                    yield DONE, data
+                    return
+                yield kind, data
+
+            # timed out or cancelled: stop the worker, and collect what it
+            # flushes on its way out
+            self._process.terminate()
+            deadline = time.monotonic() + FLUSH_GRACE
+            while self._conn.poll(max(deadline - time.monotonic(), 0)):
+                try:
+                    kind, data = self._conn.recv()
+                except EOFError:
+                    break
+                if kind == DONE:
+                    break
+                yield kind, data
+            self.close()
+            finished = True
+            yield DONE, status
+        finally:
+            if not finished:
+                # the reader went away in the middle of the script
+                self._process.terminate()
+                self.close()
+
+    def close(self):
+        """
+        Stop the worker process.
+        """
+        if self.alive:
+            self.alive = False
+            try:
+                self._conn.send(None)
+            except (OSError, ValueError):
+                pass
+            self._conn.close()
+            self._process.join(FLUSH_GRACE)
+            if self._process.is_alive():
+                self._process.kill()
+                self._process.join()
+
+
+class WorkerPool:
+    """
+    A bounded pool of workers. Requests wait for an idle worker, and workers
+    are replaced after timing out or after running max_jobs scripts.
+    """
+    def __init__(self, size, max_jobs=100):
+        """
+        Arguments:
+            size -- the number of worker processes
+            max_jobs -- how many scripts a worker runs before it is recycled
+        """
+        self._max_jobs = max_jobs
+        self.size = size
+        self._idle = [Worker() for _ in range(size)]
+        self._available = threading.Condition()
+
+    def busy(self):
+        """
+        Return the number of workers running a script.
+        """
+        with self._available:
+            return self.size - len(self._idle)
+
+    def run(self, code, flags, input_list, timeout, max_steps=None, snapshot=None, cancelled=None):
+        """
+        Run a script on the next idle worker, and return its output, its error
+        message, and its status (see Worker.stream).
+        """
+        worker = self._acquire()
+        try:
+            return worker.run(code, flags, input_list, timeout, max_steps, snapshot, cancelled)
+        finally:
+            self._release(worker)
+
+    def stream(self, code, flags, input_list, timeout, max_steps=None, snapshot=None, cancelled=None):
+        """
+        Run a script on the next idle worker, yielding its output as it is
+        produced (see Worker.stream), after (STATS, {"queue_wait": seconds})
+        with the time spent waiting for the worker.
+        """
+        start = time.monotonic()
+        worker = self._acquire()
+        try:
+            yield STATS, {"queue_wait": time.monotonic() - start}
+            yield from worker.stream(code, flags, input_list, timeout, max_steps, snapshot, cancelled)
+        finally:
+            self._release(worker)
+
+    def _acquire(self):
+        """
+        Wait for an idle worker and take it.
+        """
+        with self._available:
+            while not self._idle:
+                self._available.wait()
+            return self._idle.pop()
+
+    def _release(self, worker):
+        """
+        Return a worker to the pool, replacing it if it has to be recycled.
+        """
+        if not worker.alive or worker.jobs >= self._max_jobs:
+            worker.close()
+            worker = Worker()
+        with self._available:
+            self._idle.append(worker)
+            self._available.notify()
+
+    def close(self):
+        """
+        Stop all idle workers.
+        """
+        with self._available:
+            for worker in self._idle:
+                worker.close()
+            self._idle = []